@@ -0,0 +1,28 @@
+from importlib import import_module
+
+from django.apps import AppConfig
+
+
+# Modules that keep derived data (read models, search keys, closure
+# tables, statistics, cache versions) up to date from the bitemporal
+# write hooks.  Their signal handlers are connected when they're
+# imported, so they must all be imported in every process that writes,
+# whether or not that process reads the derived data itself.
+HOOK_MODULES = (
+    'cadasta.models.attribute_search',
+    'cadasta.models.attributes',
+    'cadasta.models.party_graph',
+    'cadasta.models.project_stats',
+    'cadasta.models.questionnaire_forms',
+    'cadasta.models.spatial_hierarchy',
+    'cadasta.models.spatial_tiles',
+    'cadasta.models.tenure_listing',
+)
+
+
+class CadastaConfig(AppConfig):
+    name = 'cadasta'
+
+    def ready(self):
+        for module in HOOK_MODULES:
+            import_module(module)
@@ -0,0 +1,128 @@
+"""
+Concurrency stress test for optimistic bitemporal updates.
+
+Writer threads repeatedly increment a counter attribute on parties
+picked at random from a small shared pool, using
+``cadasta.models.temporal.optimistic_update``, so that they keep
+colliding.  At the end each party's counter must equal the number of
+increments reported as written: any difference is a lost update.
+
+Unlike the other benchmarks, the writers need to see each other's
+commits, so the test parties are really written (and closed again at
+the end, leaving their history behind).  Run against a scratch
+database, passing the ID of an existing project:
+
+    DJANGO_SETTINGS_MODULE=... python -m cadasta.benchmarks.concurrency 1
+
+The result is printed as a JSON object.
+
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+
+def increment(party):
+    attributes = dict(party.attributes or {})
+    attributes['counter'] = attributes.get('counter', 0) + 1
+    party.attributes = attributes
+
+
+def run(project_id, parties=10, writers=8, updates=200, retries=10, seed=0):
+    from django.db import connection
+    from cadasta.models.party import Party
+    from cadasta.models.temporal import (VersionConflict, derived_id,
+                                         optimistic_update)
+
+    ids = [derived_id('concurrency', project_id, seed, i)
+           for i in range(parties)]
+    Party.objects.bulk_save(
+        Party(id=party_id, project_id=project_id, name='party {}'.format(n),
+              attributes={'counter': 0})
+        for n, party_id in enumerate(ids)
+    )
+
+    lock = threading.Lock()
+    stats = Counter()
+    increments = Counter()
+
+    def writer(n):
+        rnd = random.Random(seed * 1000 + n)
+        local_stats = Counter()
+        local_increments = Counter()
+
+        def merge(mine, latest):
+            local_stats['retries'] += 1
+            increment(latest)
+            return latest
+
+        try:
+            for _ in range(updates):
+                party_id = rnd.choice(ids)
+                try:
+                    optimistic_update(Party, [party_id], increment,
+                                      merge=merge, retries=retries)
+                except VersionConflict:
+                    local_stats['failed'] += 1
+                else:
+                    local_stats['written'] += 1
+                    local_increments[party_id] += 1
+        finally:
+            connection.close()
+        with lock:
+            stats.update(local_stats)
+            increments.update(local_increments)
+
+    threads = [threading.Thread(target=writer, args=(n,))
+               for n in range(writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    final = dict(Party.objects.current().filter(id__in=ids)
+                 .values_list('id', 'attributes'))
+    lost = sum(increments[party_id] - final[party_id].get('counter', 0)
+               for party_id in ids)
+    Party.objects.bulk_close(ids)
+    return {
+        'benchmark': 'concurrency',
+        'parties': parties,
+        'writers': writers,
+        'updates': writers * updates,
+        'seconds': seconds,
+        'written': stats['written'],
+        'retries': stats['retries'],
+        'failed': stats['failed'],
+        'lost_updates': lost,
+        'rate': stats['written'] / seconds if seconds else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('project_id', type=int)
+    parser.add_argument('--parties', type=int, default=10)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--updates', type=int, default=200,
+                        help='Updates per writer.')
+    parser.add_argument('--retries', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+    result = run(args.project_id, args.parties, args.writers, args.updates,
+                 args.retries, args.seed)
+    print(json.dumps(result))
+    if result['lost_updates']:
+        raise SystemExit('lost updates: {}'.format(result['lost_updates']))
+
+
+if __name__ == '__main__':
+    main()
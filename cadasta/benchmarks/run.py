@@ -0,0 +1,251 @@
+"""
+Run the data model benchmark suite against synthetic data.
+
+Run against a scratch PostGIS database with the migrations (and the
+index SQL from ``cadasta.models.temporal.temporal_index_sql``)
+applied:
+
+    DJANGO_SETTINGS_MODULE=... python -m cadasta.benchmarks.run \\
+        --scale small --seed 1 --output results.json
+
+The synthetic data (see ``cadasta.benchmarks.synthetic``) is generated
+from the seed, the key read and write paths are timed against it, and
+everything is rolled back at the end.  Results are written as a single
+JSON document; pass an earlier results file with ``--compare`` to
+print the change in each timing.
+
+"""
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+
+from django.utils import timezone
+
+from .temporal_reads import timed
+
+
+def attribute_resolution(dataset, repeat):
+    from cadasta.models.attributes import (Attribute, attribute_cache,
+                                           validator_cache)
+
+    objs = dataset.parties + dataset.parcels + dataset.tenure
+
+    def cold():
+        attribute_cache.clear()
+        validator_cache.clear()
+        Attribute.objects.attribute_set(dataset.parties[0])
+
+    def warm():
+        for obj in objs:
+            Attribute.objects.attribute_set(obj)
+
+    def validate():
+        Attribute.objects.validate_many(dataset.parties)
+
+    return [('cold', timed(cold, repeat), 1),
+            ('warm', timed(warm, repeat), len(objs)),
+            ('validate_many', timed(validate, repeat), len(dataset.parties))]
+
+
+def bitemporal_save(dataset, repeat):
+    from cadasta.models.party import Party
+    from cadasta.models.spatial_unit import SpatialUnit
+
+    def parties():
+        Party.objects.bulk_save(dataset.parties)
+
+    def parcels():
+        SpatialUnit.objects.bulk_save(dataset.parcels)
+
+    def close():
+        # Closing and then re-saving keeps the data set intact.
+        Party.objects.bulk_close(party.id for party in dataset.parties)
+        Party.objects.bulk_save(dataset.parties)
+
+    return [('parties', timed(parties, repeat), len(dataset.parties)),
+            ('parcels', timed(parcels, repeat), len(dataset.parcels)),
+            ('close_and_save', timed(close, repeat), len(dataset.parties))]
+
+
+def as_of_reads(dataset, repeat):
+    from cadasta.models.party import Party
+    from cadasta.models.spatial_unit import SpatialUnit
+
+    results = []
+    for model in (Party, SpatialUnit):
+        name = model._meta.model_name
+        queryset = model.objects.filter(project=dataset.project)
+        results.append((name + '.current',
+                        timed(lambda: list(queryset.current()), repeat),
+                        None))
+        for n, when in enumerate(dataset.times):
+            results.append((
+                '{}.as_of.v{}'.format(name, n + 1),
+                timed(lambda: list(queryset.as_of(effective=when)), repeat),
+                None
+            ))
+    return results
+
+
+def tenure_listing(dataset, repeat, page=100):
+    from cadasta.models.tenure_relationship import TenureRelationship
+    from cadasta.models import tenure_listing as read_model
+
+    queryset = (TenureRelationship.objects.current()
+                .filter(project=dataset.project).order_by('id')
+                .prefetch_temporal('party', 'spatial_unit', 'type'))
+
+    def first_page():
+        list(queryset[:page])
+
+    def everything():
+        list(queryset)
+
+    def rebuild():
+        read_model.rebuild(dataset.project)
+
+    def read_model_page():
+        read_model.page(dataset.project, limit=page)
+
+    return [('page', timed(first_page, repeat), page),
+            ('all', timed(everything, repeat), len(dataset.tenure)),
+            ('read_model.rebuild', timed(rebuild, 1), len(dataset.tenure)),
+            ('read_model.page', timed(read_model_page, repeat), page)]
+
+
+def export(dataset, repeat):
+    from cadasta.models.export import export_project
+
+    rows = []
+    directory = tempfile.mkdtemp()
+
+    def run():
+        rows.append(export_project(dataset.project, directory,
+                                   formats=('csv', 'geojson')).total_rows)
+
+    try:
+        seconds = timed(run, repeat)
+    finally:
+        shutil.rmtree(directory)
+    return [('csv_geojson', seconds, rows[-1])]
+
+
+def ingest(dataset, repeat):
+    from cadasta.models.questionnaire_ingest import ingest as ingest_raw
+
+    def run():
+        ingest_raw(dataset.questionnaire)
+
+    return [('submissions', timed(run, repeat), len(dataset.submissions))]
+
+
+BENCHMARKS = (('attribute_resolution', attribute_resolution),
+              ('bitemporal_save', bitemporal_save),
+              ('as_of_reads', as_of_reads),
+              ('tenure_listing', tenure_listing),
+              ('export', export),
+              ('ingest', ingest))
+
+
+def run(seed=0, scale='small', repeat=3, only=None, instrument=False,
+        **overrides):
+    """
+    Generate a synthetic data set and run the benchmarks on it (all of
+    them, or those named in ``only``), returning a results dict.  With
+    ``instrument``, the counters and latency histograms collected by
+    ``cadasta.models.instrumentation`` are included too (the timings
+    then include the instrumentation overhead).
+    """
+    from django.db import transaction
+    from cadasta.models import instrumentation
+    from .synthetic import Generator
+
+    generator = Generator(seed, scale, **overrides)
+    results = []
+    metrics = instrumentation.MemoryExporter()
+    if instrument:
+        instrumentation.enable(metrics)
+    try:
+        with transaction.atomic():
+            datasets = generator.populate()
+            for group, benchmark in BENCHMARKS:
+                if only and group not in only:
+                    continue
+                for dataset in datasets:
+                    for name, seconds, rows in benchmark(dataset, repeat):
+                        rate = rows / seconds if rows and seconds else None
+                        results.append({
+                            'benchmark': '{}.{}'.format(group, name),
+                            'project': dataset.project.pk,
+                            'seconds': seconds,
+                            'rows': rows,
+                            'rate': rate,
+                        })
+            transaction.set_rollback(True)
+    finally:
+        instrumentation.disable()
+    report = {'seed': seed, 'scale': scale, 'config': generator.config,
+              'repeat': repeat, 'started': timezone.now().isoformat(),
+              'python': platform.python_version(), 'results': results}
+    if instrument:
+        report['metrics'] = metrics.snapshot()
+    return report
+
+
+def compare(previous, current):
+    """
+    Lines comparing the timings in two results dicts, matched on
+    benchmark name and project order.
+    """
+    def timings(results):
+        projects = sorted(set(r['project'] for r in results['results']))
+        return dict(((r['benchmark'], projects.index(r['project'])),
+                     r['seconds']) for r in results['results'])
+
+    before = timings(previous)
+    after = timings(current)
+    for key in sorted(after):
+        if key not in before:
+            continue
+        change = after[key] / before[key] - 1 if before[key] else 0.0
+        yield '{} [{}]: {:.4f}s -> {:.4f}s ({:+.1%})'.format(
+            key[0], key[1], before[key], after[key], change)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scale', default='small',
+                        choices=['small', 'medium', 'large'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+',
+                        choices=[name for name, _ in BENCHMARKS])
+    parser.add_argument('--instrument', action='store_true',
+                        help='Include instrumentation metrics.')
+    parser.add_argument('--output', help='File to write results to '
+                        '(default: standard output).')
+    parser.add_argument('--compare', help='Earlier results file to '
+                        'compare against.')
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+    results = run(args.seed, args.scale, args.repeat, args.only,
+                  args.instrument)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    if args.compare:
+        with open(args.compare) as previous:
+            for line in compare(json.load(previous), results):
+                sys.stderr.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""
+Seeded synthetic data for benchmarks: organizations, projects,
+parties, spatial units with realistic polygons, multi-version
+histories, relationships and questionnaire submissions.
+
+The same seed and scale always give the same data (including entity
+IDs, which are derived from the seed and each project's ordinal, never
+from database-assigned keys), so timings from different runs are
+comparable.  Import this after ``django.setup()``.
+
+"""
+import random
+import uuid
+from collections import namedtuple
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.gis.geos import Polygon
+from django.utils import timezone
+
+from cadasta.models.organization import Organization
+from cadasta.models.project import Project
+from cadasta.models.party import Party, PartyRelationship
+from cadasta.models.resource import Resource
+from cadasta.models.spatial_unit import SpatialUnit
+from cadasta.models.tenure_relationship import (TenureRelationship,
+                                                TenureRelationshipType)
+from cadasta.models.questionnaire_data import (Questionnaire,
+                                               QuestionSection, Question,
+                                               QuestionOption,
+                                               RawQuestionnaireData)
+from cadasta.models.temporal import derived_id
+
+
+# Scales, by number of rows per project.  ``versions`` is the number of
+# versions written for the entities that get a history, and
+# ``churn`` the fraction of parties and parcels that get one.
+SCALES = {
+    'small': dict(projects=1, parties=1000, parcels=1000, versions=3,
+                  churn=0.2, submissions=200),
+    'medium': dict(projects=2, parties=20000, parcels=20000, versions=5,
+                   churn=0.2, submissions=5000),
+    'large': dict(projects=4, parties=100000, parcels=100000, versions=10,
+                  churn=0.1, submissions=50000),
+}
+
+# Parcel size in degrees (roughly 30m at the equator).
+CELL = 0.0003
+
+TENURE_TYPES = (('RIGHT', 'freehold', 'Freehold'),
+                ('RIGHT', 'lease', 'Leasehold'),
+                ('RESTR', 'easement', 'Easement'))
+
+QUESTIONS = (('name', 'TX', ()),
+             ('age', 'IN', ()),
+             ('phone', 'PH', ()),
+             ('tenure', 'S1', ('owner', 'tenant', 'occupant')),
+             ('use', 'SA', ('housing', 'farming', 'grazing', 'business')),
+             ('location', 'GE', ()))
+
+FIRST_NAMES = ('Amina', 'Jose', 'Li', 'Maria', 'Kwame', 'Priya', 'Omar',
+               'Ana', 'Thabo', 'Nguyen', 'Fatima', 'Juan', 'Grace', 'Ravi')
+LAST_NAMES = ('Okafor', 'Silva', 'Wang', 'Garcia', 'Mensah', 'Sharma',
+              'Haddad', 'Santos', 'Nkosi', 'Tran', 'Diallo', 'Lopez')
+
+Dataset = namedtuple('Dataset', 'project parties parcels tenure '
+                                'questionnaire submissions times')
+
+
+class Generator(object):
+    """
+    Synthetic data generator.  ``overrides`` replace individual
+    settings of the chosen scale, e.g. ``Generator(1, 'small',
+    parties=50)``.
+
+    """
+    def __init__(self, seed=0, scale='small', **overrides):
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.config = dict(SCALES[scale], **overrides)
+
+    def id(self, *parts):
+        return derived_id('synthetic', self.seed, *parts)
+
+    def int_id(self, *parts):
+        """
+        A derived ID for models with integer IDs, in the upper half of
+        the positive integer range so it can't meet the values handed
+        out by the ID sequence.
+        """
+        return 2 ** 30 + int(self.id(*parts), 16) % 2 ** 30
+
+    def populate(self):
+        """
+        Write an organization and the configured number of projects,
+        returning a ``Dataset`` per project.
+        """
+        # Temporal foreign keys hold entity IDs, so the logos and
+        # extents can be referred to before they're written.
+        organization = Organization.objects.create(
+            name='Synthetic organization {}'.format(self.seed), urls=[],
+            contacts=[], logo_id=self.id('logo', 'organization')
+        )
+        return [self.project(organization, n)
+                for n in range(self.config['projects'])]
+
+    def project(self, organization, n):
+        config = self.config
+        extent_id = self.id('extent', n)
+        project = Project.objects.create(
+            name='Synthetic project {}'.format(n), organization=organization,
+            country='KE', urls=[], contacts=[],
+            logo_id=self.id('logo', n), geometry_id=extent_id
+        )
+        logos = [(project, project.logo_id)]
+        if n == 0:
+            logos.append((organization, organization.logo_id))
+        self.logos(project, logos)
+        # Versions are back-dated one day apart, so as-of reads have a
+        # history to look at.
+        start = timezone.now() - timedelta(days=config['versions'] + 1)
+        times = [start + timedelta(days=k) for k in range(config['versions'])]
+
+        parties = self.parties(project, n, config['parties'], effective=start)
+        parcels = self.parcels(project, n, config['parcels'], extent_id,
+                               effective=start)
+        self.party_relationships(project, parties, effective=start)
+        tenure = self.tenure(project, n, parties, parcels, effective=start)
+        for effective in times[1:]:
+            self.revise(parties, parcels, effective)
+        questionnaire = self.questionnaire(project)
+        submissions = self.submissions(questionnaire, n,
+                                       config['submissions'])
+        return Dataset(project, parties, parcels, tenure, questionnaire,
+                       submissions, times)
+
+    def parties(self, project, n, count, effective=None):
+        """
+        Individuals, with a group for every ten or so, for the project
+        with ordinal ``n``.
+        """
+        rnd = self.random
+        parties = []
+        for i in range(count):
+            group = i % 10 == 0
+            name = ('{} household'.format(rnd.choice(LAST_NAMES)) if group
+                    else '{} {}'.format(rnd.choice(FIRST_NAMES),
+                                        rnd.choice(LAST_NAMES)))
+            parties.append(Party(
+                id=self.id('party', n, i), project=project,
+                name=name, type=Party.GROUP if group else Party.INDIVIDUAL,
+                attributes={}
+            ))
+        return Party.objects.bulk_save(parties, effective=effective)
+
+    def logos(self, project, logos):
+        """
+        Logo resources, given (owner, resource ID) pairs.
+        """
+        return Resource.objects.bulk_save(
+            Resource(id=resource_id, project=project,
+                     resource='synthetic/logo.png', mime_type='image/png',
+                     type='logo', attributes={},
+                     obj_type=ContentType.objects.get_for_model(owner),
+                     obj_id=str(owner.pk))
+            for owner, resource_id in logos
+        )
+
+    def parcels(self, project, n, count, extent_id, effective=None):
+        """
+        Parcels on a jittered grid: neighbouring parcels share their
+        (perturbed) corners, so they tile the area without overlaps,
+        like a real cadastre, for the project with ordinal ``n``.  Also
+        writes the project extent (with the given ID) and a community
+        boundary covering the grid.  Returns the parcels.
+        """
+        rnd = self.random
+        side = max(1, int(count ** 0.5 + 0.999))
+        x0 = rnd.uniform(34.0, 40.0)
+        y0 = rnd.uniform(-4.0, 4.0)
+        corners = {}
+        for i in range(side + 1):
+            for j in range(side + 1):
+                edge = i in (0, side) or j in (0, side)
+                jitter = 0 if edge else CELL * 0.3
+                dx = rnd.uniform(-jitter, jitter)
+                dy = rnd.uniform(-jitter, jitter)
+                corners[(i, j)] = (x0 + i * CELL + dx, y0 + j * CELL + dy)
+        units = []
+        for k in range(count):
+            i, j = divmod(k, side)
+            ring = [corners[(i, j)], corners[(i + 1, j)],
+                    corners[(i + 1, j + 1)], corners[(i, j + 1)],
+                    corners[(i, j)]]
+            units.append(SpatialUnit(
+                id=self.id('parcel', n, k), project=project,
+                type=SpatialUnit.PARCEL, geometry=Polygon(ring, srid=4326),
+                attributes={}
+            ))
+        bbox = (x0, y0, x0 + side * CELL, y0 + side * CELL)
+        margin = CELL * 10
+        boundary = SpatialUnit(
+            id=self.id('boundary', n), project=project,
+            type=SpatialUnit.COMMUNITY_BOUNDARY, attributes={},
+            geometry=Polygon.from_bbox(bbox)
+        )
+        extent = SpatialUnit(
+            id=extent_id, project=project,
+            type=SpatialUnit.PROJECT_EXTENT, attributes={},
+            geometry=Polygon.from_bbox((bbox[0] - margin, bbox[1] - margin,
+                                        bbox[2] + margin, bbox[3] + margin))
+        )
+        for unit in (boundary, extent):
+            unit.geometry.srid = 4326
+        SpatialUnit.objects.bulk_save(units + [boundary, extent],
+                                      effective=effective)
+        return units
+
+    def party_relationships(self, project, parties, effective=None):
+        """
+        Make the individuals following each group its members.
+        """
+        relationships = []
+        group = None
+        for party in parties:
+            if party.type == Party.GROUP:
+                group = party
+                continue
+            if group is not None:
+                relationships.append(PartyRelationship(
+                    id=self.id('member', party.id, group.id),
+                    project=project, party1=party, party2=group, type='M',
+                    attributes={}
+                ))
+        return PartyRelationship.objects.bulk_save(relationships,
+                                                   effective=effective)
+
+    def tenure(self, project, n, parties, parcels, effective=None):
+        """
+        One or two tenure relationships per parcel, with the tenure
+        types for the project with ordinal ``n``.
+        """
+        rnd = self.random
+        types = TenureRelationshipType.objects.bulk_save(
+            TenureRelationshipType(id=self.int_id('tenure-type', n, name),
+                                   project=project, type=basic, name=name,
+                                   description=description)
+            for basic, name, description in TENURE_TYPES
+        )
+        relationships = []
+        for parcel in parcels:
+            holders = 2 if rnd.random() < 0.2 else 1
+            for k in range(holders):
+                relationships.append(TenureRelationship(
+                    id=self.id('tenure', parcel.id, k), project=project,
+                    party=rnd.choice(parties), spatial_unit=parcel,
+                    type=rnd.choice(types), attributes={}
+                ))
+        return TenureRelationship.objects.bulk_save(relationships,
+                                                    effective=effective)
+
+    def revise(self, parties, parcels, effective):
+        """
+        Write new versions of a random sample of parties (renamed) and
+        parcels (corners nudged) as of ``effective``.
+        """
+        rnd = self.random
+        churn = self.config['churn']
+        changed = rnd.sample(parties, int(len(parties) * churn))
+        for party in changed:
+            party.name = '{} {}'.format(rnd.choice(FIRST_NAMES),
+                                        party.name.split(' ', 1)[-1])
+        Party.objects.bulk_save(changed, effective=effective)
+
+        changed = rnd.sample(parcels, int(len(parcels) * churn))
+        for parcel in changed:
+            ring = list(parcel.geometry.exterior_ring.coords)
+            dx = rnd.uniform(-CELL, CELL) * 0.01
+            ring = [(x + dx, y) for x, y in ring]
+            parcel.geometry = Polygon(ring, srid=4326)
+        SpatialUnit.objects.bulk_save(changed, effective=effective)
+
+    def questionnaire(self, project):
+        """
+        A single-section questionnaire with a fixed set of questions.
+        """
+        questionnaire = Questionnaire.objects.create(
+            raw_form={}, name='synthetic', label='Synthetic survey',
+            project=project, id_string='synthetic', form_id=1
+        )
+        section = QuestionSection.objects.create(
+            name='main', label='Main', questionnaire=questionnaire
+        )
+        for name, question_type, options in QUESTIONS:
+            question = Question.objects.create(
+                name=name, label=name.title(), type=question_type,
+                section=section, questionnaire=questionnaire
+            )
+            for option in options:
+                QuestionOption.objects.create(question=question, name=option,
+                                              label=option.title())
+        return questionnaire
+
+    def submissions(self, questionnaire, n, count):
+        """
+        Raw ODK-style submissions for the project with ordinal ``n``,
+        saved as ``RawQuestionnaireData`` and returned as a list of
+        dicts.
+        """
+        rnd = self.random
+        submissions = []
+        for k in range(count):
+            key = uuid.UUID(int=rnd.getrandbits(128), version=4)
+            submissions.append({
+                '_id': k,
+                '_uuid': str(key),
+                'name': '{} {}'.format(rnd.choice(FIRST_NAMES),
+                                       rnd.choice(LAST_NAMES)),
+                'age': rnd.randint(18, 90),
+                'phone': '+2547{:08d}'.format(rnd.randrange(10 ** 8)),
+                'tenure': rnd.choice(QUESTIONS[3][2]),
+                'use': ' '.join(rnd.sample(QUESTIONS[4][2],
+                                           rnd.randint(1, 3))),
+                'location': '{:.6f} {:.6f} 0 5'.format(
+                    rnd.uniform(-4.0, 4.0), rnd.uniform(34.0, 40.0)),
+            })
+        RawQuestionnaireData.objects.bulk_save(
+            RawQuestionnaireData(id=self.id('raw', n, k),
+                                 questionnaire=questionnaire, data=data)
+            for k, data in enumerate(submissions)
+        )
+        return submissions
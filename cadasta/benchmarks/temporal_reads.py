@@ -0,0 +1,90 @@
+"""
+Benchmark current-state against historical reads of bitemporal data as
+the number of versions per entity grows.
+
+Run against a scratch PostGIS database that has the temporal indexes
+from ``cadasta.models.temporal.temporal_index_sql`` installed, passing
+the ID of an existing project to hang the test data off:
+
+    DJANGO_SETTINGS_MODULE=... python -m cadasta.benchmarks.temporal_reads 1
+
+Everything written is rolled back at the end.  Results are printed as
+one JSON object per line.
+
+"""
+import argparse
+import json
+import time
+
+
+def timed(func, repeat):
+    """
+    Best wall-clock time for ``func`` over ``repeat`` runs.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(project_id, parties=1000, versions=(1, 5, 20, 50), repeat=5):
+    from django.db import transaction
+    from django.utils import timezone
+    from cadasta.models.party import Party
+    from cadasta.models.temporal import derived_id
+
+    def current():
+        list(Party.objects.current().filter(project_id=project_id))
+
+    def historical():
+        list(Party.objects.as_of(effective=first, asserted=first)
+             .filter(project_id=project_id))
+
+    results = []
+    with transaction.atomic():
+        objs = Party.objects.bulk_save(
+            Party(id=derived_id('temporal_reads', project_id, i),
+                  project_id=project_id, name='party {}'.format(i),
+                  attributes={})
+            for i in range(parties)
+        )
+        first = timezone.now()
+        written = 1
+        for target in sorted(versions):
+            while written < target:
+                for obj in objs:
+                    obj.name = 'party {} v{}'.format(obj.id, written)
+                Party.objects.bulk_save(objs)
+                written += 1
+            results.append({
+                'benchmark': 'temporal_reads',
+                'parties': parties,
+                'versions': target,
+                'current': timed(current, repeat),
+                'historical': timed(historical, repeat),
+            })
+        transaction.set_rollback(True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('project_id', type=int)
+    parser.add_argument('--parties', type=int, default=1000)
+    parser.add_argument('--versions', type=int, nargs='+',
+                        default=[1, 5, 20, 50])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    import django
+    django.setup()
+    for result in run(args.project_id, args.parties, args.versions,
+                      args.repeat):
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from cadasta.models.archive import compact
+
+
+class Command(BaseCommand):
+    help = ('Move closed bitemporal versions older than the policy window '
+            'into the archive tables and report what was moved.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365,
+                            help='Policy window in days (default 365).')
+        parser.add_argument('--vacuum', action='store_true',
+                            help='Vacuum the main tables afterwards.')
+
+    def handle(self, *args, **options):
+        report = compact(window=timedelta(days=options['days']),
+                         vacuum=options['vacuum'])
+        self.stdout.write('Archived versions closed before {}'.format(
+            report.cutoff.isoformat()))
+        for line in report.lines():
+            self.stdout.write(line)
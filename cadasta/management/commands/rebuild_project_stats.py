@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from cadasta.models.project import Project
+from cadasta.models.project_stats import rebuild
+
+
+class Command(BaseCommand):
+    help = ('Recompute the incrementally maintained project statistics '
+            'and report any that had drifted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('project_ids', nargs='*', type=int,
+                            help='Projects to check (default: all).')
+
+    def handle(self, *args, **options):
+        projects = Project.objects.all()
+        if options['project_ids']:
+            projects = projects.filter(pk__in=options['project_ids'])
+        for project in projects.iterator():
+            diffs = rebuild(project)
+            for (kind, key), (stored, computed) in sorted(diffs.items()):
+                self.stdout.write(
+                    'project {}: {} {}: stored {} / {}, computed {} / {}'
+                    .format(project.pk, kind, key, stored[0], stored[1],
+                            computed[0], computed[1])
+                )
+            if not diffs:
+                self.stdout.write('project {}: OK'.format(project.pk))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from cadasta.models.project import Project
+from cadasta.models.tenure_listing import rebuild
+
+
+class Command(BaseCommand):
+    help = ('Repopulate the denormalised tenure listing rows from the '
+            'current tenure relationships.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('project_ids', nargs='*', type=int,
+                            help='Projects to rebuild (default: all).')
+
+    def handle(self, *args, **options):
+        projects = Project.objects.all()
+        if options['project_ids']:
+            projects = projects.filter(pk__in=options['project_ids'])
+        for project in projects.iterator():
+            count = rebuild(project)
+            self.stdout.write('project {}: {} rows'.format(project.pk, count))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from cadasta.models.project import Project
+from cadasta.models.attribute_search import SEARCH_MODELS, reindex
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the attribute search keys, e.g. after changing which '
+            'attributes are searchable.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('project_ids', nargs='*', type=int,
+                            help='Projects to reindex (default: all).')
+
+    def handle(self, *args, **options):
+        projects = Project.objects.all()
+        if options['project_ids']:
+            projects = projects.filter(pk__in=options['project_ids'])
+        for project in projects.iterator():
+            for model in SEARCH_MODELS:
+                count = reindex(model, project)
+                self.stdout.write('project {}: {} {} indexed'.format(
+                    project.pk, count, model._meta.verbose_name_plural))
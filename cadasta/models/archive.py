@@ -0,0 +1,145 @@
+from datetime import timedelta
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .attributes import Attribute
+from .party import Party, PartyRelationship
+from .spatial_unit import SpatialUnit, SpatialUnitRelationship
+from .tenure_relationship import TenureRelationship, TenureRelationshipType
+from .resource import Resource
+from .change_feed import FEED_MODELS, change_feed_index_sql
+from .questionnaire_data import (Questionnaire, QuestionSection, QuestionGroup,
+                                 Question, QuestionOption,
+                                 RawQuestionnaireData, QuestionRespondent,
+                                 QuestionResponse)
+from .temporal import ASSERT_FROM, ASSERT_TO, EFFECTIVE_FROM, EFFECTIVE_TO
+
+
+# Archive tier for bitemporal history.  Each bitemporal table gets an
+# archive table that inherits from it (PostgreSQL table inheritance),
+# and compaction moves closed versions that are older than a policy
+# window from the main table into its archive.
+#
+# Because the archive is a child table, queries against the main table
+# still see archived rows, so history reads through ``as_of`` work
+# exactly as before.  The archive has a CHECK constraint saying it
+# only holds closed versions, so with constraint exclusion (the
+# default "partition" setting) queries for current versions never
+# touch it.  The main table is left holding current versions and
+# recent history, which keeps it and its indexes small.
+
+ARCHIVED_MODELS = (Party, PartyRelationship, SpatialUnit,
+                   SpatialUnitRelationship, TenureRelationship,
+                   TenureRelationshipType, Resource, Attribute,
+                   Questionnaire, QuestionSection, QuestionGroup, Question,
+                   QuestionOption, RawQuestionnaireData, QuestionRespondent,
+                   QuestionResponse)
+
+DEFAULT_WINDOW = timedelta(days=365)
+
+
+def archive_table(model):
+    return model._meta.db_table + '_archive'
+
+
+def archive_sql(model):
+    """
+    SQL to create the archive table for a model, for use in a
+    ``RunSQL`` migration.  Indexes aren't inherited, so the archive
+    gets its own: the as-of GiST index (project first, like the main
+    table's), an ID index, and the change feed indexes for feed
+    models, since history reads and the feed both scan the archive.
+    """
+    table = model._meta.db_table
+    archive = archive_table(model)
+    fields = [f.name for f in model._meta.concrete_fields]
+    keys = ['"project_id"'] if 'project' in fields else []
+    keys += ['tstzrange("{0}", "{1}")'.format(EFFECTIVE_FROM, EFFECTIVE_TO),
+             'tstzrange("{0}", "{1}")'.format(ASSERT_FROM, ASSERT_TO)]
+    sql = [
+        'CREATE EXTENSION IF NOT EXISTS btree_gist',
+        'CREATE TABLE "{0}" () INHERITS ("{1}")'.format(archive, table),
+        'ALTER TABLE "{0}" ADD CONSTRAINT "{0}_closed" '
+        'CHECK ("{1}" IS NOT NULL OR "{2}" IS NOT NULL)'.format(
+            archive, EFFECTIVE_TO, ASSERT_TO),
+        'CREATE INDEX "{0}_as_of" ON "{0}" USING gist ({1})'.format(
+            archive, ', '.join(keys)),
+        'CREATE INDEX "{0}_id" ON "{0}" ("id")'.format(archive),
+    ]
+    if model in FEED_MODELS:
+        sql.extend(change_feed_index_sql(model, archive))
+    return sql
+
+
+class CompactionReport(object):
+    def __init__(self, cutoff):
+        self.cutoff = cutoff
+        self.rows = {}
+        self.bytes = {}
+
+    @property
+    def total_rows(self):
+        return sum(self.rows.values())
+
+    @property
+    def total_bytes(self):
+        return sum(self.bytes.values())
+
+    def lines(self):
+        for label in sorted(self.rows):
+            yield '{}: {} rows, {} bytes'.format(label, self.rows[label],
+                                                 self.bytes[label])
+        yield 'total: {} rows, {} bytes'.format(self.total_rows,
+                                                self.total_bytes)
+
+
+def compact(models=ARCHIVED_MODELS, window=DEFAULT_WINDOW, using='default',
+            vacuum=False):
+    """
+    Move closed versions whose assertion was retracted, or whose
+    effective time ended, more than ``window`` ago into the archive
+    tables.  Each model is moved in its own transaction with a single
+    statement.  Returns a ``CompactionReport`` with the rows and bytes
+    (tuple sizes) moved out of each main table.  With ``vacuum``, the
+    main tables are vacuumed afterwards so the space can be reused
+    (this can't be done inside a transaction).
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cutoff = timezone.now() - window
+    report = CompactionReport(cutoff)
+    for model in models:
+        table = model._meta.db_table
+        sql = ('WITH moved AS ('
+               'DELETE FROM ONLY {table} '
+               'WHERE {assert_to} < %s OR {effective_to} < %s '
+               'RETURNING *), '
+               'archived AS (INSERT INTO {archive} SELECT * FROM moved) '
+               'SELECT count(*), coalesce(sum(pg_column_size(moved.*)), 0) '
+               'FROM moved').format(table=qn(table),
+                                    archive=qn(archive_table(model)),
+                                    assert_to=qn(ASSERT_TO),
+                                    effective_to=qn(EFFECTIVE_TO))
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [cutoff, cutoff])
+                rows, size = cursor.fetchone()
+        label = model._meta.label_lower
+        report.rows[label] = rows
+        report.bytes[label] = int(size)
+        if vacuum and rows:
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM ANALYZE {}'.format(qn(table)))
+    return report
+
+
+def archived(model):
+    """
+    Query set over the archived versions of a model only.
+    """
+    return model.objects.extra(
+        where=['"{0}".tableoid = \'"{1}"\'::regclass'.format(
+            model._meta.db_table, archive_table(model))]
+    )
+
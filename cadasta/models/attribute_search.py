@@ -0,0 +1,281 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+
+from cadasta.core.models import ID_FIELD_LENGTH
+
+from .attributes import Attribute
+from .party import Party, PartyRelationship
+from .project import Project
+from .spatial_unit import SpatialUnit, SpatialUnitRelationship
+from .tenure_relationship import TenureRelationship
+from .temporal import versions_saved, versions_closed
+from .validation import BASE_TYPE_CHECKS, NORMALISERS
+
+
+# Indexed search over JSON attribute values.  Searching for a party by
+# national ID or phone number would otherwise mean a sequential scan
+# over the attributes JSON of every version of every party.  Instead,
+# for attributes flagged ``searchable``, a side table holds one search
+# key per (current entity, attribute), kept up to date by the
+# bitemporal write hooks:
+#
+#  * text keys are the value after the attribute's full type
+#    normaliser (so "(555) 123-4567" and "555.123.4567" give the same
+#    key for a us-telephone-number), with whitespace collapsed and
+#    case folded;
+#
+#  * number keys are used for numeric attributes without a full type,
+#    so that range queries compare numbers.
+#
+# Search values go through the same normalisation, and equality,
+# prefix and range queries all use the B-tree indexes from
+# ``search_index_sql``.  Only current versions are indexed.  After
+# changing which attributes are searchable, run ``reindex`` (or the
+# ``reindex_attribute_search`` command).
+
+SEARCH_MODELS = (Party, PartyRelationship, SpatialUnit,
+                 SpatialUnitRelationship, TenureRelationship)
+
+NUMERIC_TYPES = ('NO', 'IN', 'FR')
+
+TEXT_KEY_LENGTH = 200
+
+
+class AttributeSearchKey(models.Model):
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    obj_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    obj_id = models.CharField(max_length=ID_FIELD_LENGTH)
+    name = models.CharField(max_length=100)
+    text_key = models.CharField(max_length=TEXT_KEY_LENGTH, null=True)
+    number_key = models.FloatField(null=True)
+
+    class Meta:
+        index_together = ['obj_type', 'obj_id']
+
+
+def search_index_sql():
+    """
+    SQL for the search key indexes, for use in a ``RunSQL`` migration.
+    Text keys use the "C" collation, so that one B-tree index serves
+    equality, prefix (LIKE) and range queries.
+    """
+    table = AttributeSearchKey._meta.db_table
+    return [
+        'ALTER TABLE "{0}" ALTER COLUMN "text_key" '
+        'TYPE varchar({1}) COLLATE "C"'.format(table, TEXT_KEY_LENGTH),
+        'CREATE INDEX "{0}_text" ON "{0}" '
+        '("project_id", "obj_type_id", "name", "text_key") '
+        'WHERE "text_key" IS NOT NULL'.format(table),
+        'CREATE INDEX "{0}_number" ON "{0}" '
+        '("project_id", "obj_type_id", "name", "number_key") '
+        'WHERE "number_key" IS NOT NULL'.format(table),
+    ]
+
+
+def _fold(text):
+    return ' '.join(text.split()).casefold()[:TEXT_KEY_LENGTH]
+
+
+def _numeric(attr):
+    """
+    Whether an attribute's values get number keys.
+    """
+    return (attr.base_type in NUMERIC_TYPES and
+            attr.full_type not in NORMALISERS)
+
+
+def search_key(attr, value):
+    """
+    The ``(text_key, number_key)`` pair for a value of an attribute,
+    or None if the value isn't valid for the attribute.
+    """
+    base = BASE_TYPE_CHECKS.get(attr.base_type, BASE_TYPE_CHECKS['TX'])
+    full = NORMALISERS.get(attr.full_type)
+    try:
+        value = base(value)
+        if full is not None:
+            value = full(str(value))
+    except (TypeError, ValueError):
+        return None
+    if _numeric(attr):
+        return None, float(value)
+    return _fold(str(value)), None
+
+
+def _prefix_key(attr, prefix):
+    """
+    Normalise a search prefix: partial values usually don't get
+    through the full type normalisers, so fall back to folding.
+    """
+    key = search_key(attr, prefix)
+    if key is not None and key[0] is not None:
+        return key[0]
+    return _fold(str(prefix))
+
+
+def index(objs):
+    """
+    Replace the search keys for the given current versions (all of one
+    model).
+    """
+    objs = list(objs)
+    if not objs:
+        return
+    obj_type = ContentType.objects.get_for_model(objs[0])
+    related = {}
+    rows = []
+    for obj in objs:
+        Attribute.objects._share_related(obj, related)
+        values = obj.attributes or {}
+        for attr in Attribute.objects.attribute_set(obj):
+            if not attr.searchable or values.get(attr.name) is None:
+                continue
+            key = search_key(attr, values[attr.name])
+            if key is None:
+                continue
+            rows.append(AttributeSearchKey(
+                project_id=obj.project_id, obj_type=obj_type, obj_id=obj.id,
+                name=attr.name, text_key=key[0], number_key=key[1]
+            ))
+    with transaction.atomic():
+        unindex(type(objs[0]), [obj.id for obj in objs])
+        AttributeSearchKey.objects.bulk_create(rows)
+
+
+def unindex(model, ids):
+    AttributeSearchKey.objects.filter(
+        obj_type=ContentType.objects.get_for_model(model), obj_id__in=ids
+    ).delete()
+
+
+def reindex(model, project, batch_size=1000):
+    """
+    Rebuild the search keys for a model's current versions in a
+    project.  Returns the number of entities indexed.
+    """
+    queryset = model.objects.current().filter(project=project)
+    count = 0
+    with transaction.atomic():
+        AttributeSearchKey.objects.filter(
+            project=project, obj_type=ContentType.objects.get_for_model(model)
+        ).delete()
+        batch = []
+        for obj in queryset.iterator():
+            batch.append(obj)
+            if len(batch) == batch_size:
+                index(batch)
+                count += len(batch)
+                batch = []
+        index(batch)
+        count += len(batch)
+    return count
+
+
+def _saved(sender, instance, **kwargs):
+    index([instance])
+
+
+def _deleted(sender, instance, **kwargs):
+    unindex(sender, [instance.id])
+
+
+def _bulk_saved(sender, instances, **kwargs):
+    index(instances)
+
+
+def _bulk_closed(sender, ids, **kwargs):
+    unindex(sender, ids)
+
+
+for _model in SEARCH_MODELS:
+    post_save.connect(_saved, sender=_model)
+    post_delete.connect(_deleted, sender=_model)
+    versions_saved.connect(_bulk_saved, sender=_model)
+    versions_closed.connect(_bulk_closed, sender=_model)
+
+
+def search(model, project, name, value=None, prefix=None,
+           lower=None, upper=None):
+    """
+    Current versions of ``model`` in a project whose searchable
+    attribute ``name`` equals ``value``, starts with ``prefix``, or
+    lies in the range [``lower``, ``upper``] (either end may be
+    omitted).  Values are normalised the same way as the stored keys.
+    Conditions given together must all hold.  An attribute that's
+    numeric for some subtypes and text for others is matched against
+    both kinds of key; only text values can be searched by prefix.
+    """
+    obj_type = ContentType.objects.get_for_model(model)
+    project_id = getattr(project, 'pk', project)
+    organization_id = (Project.objects.filter(pk=project_id)
+                       .values_list('organization_id', flat=True).first())
+    definitions = list(
+        Attribute.objects.current()
+        .filter(models.Q(organization__isnull=True) |
+                models.Q(organization_id=organization_id),
+                models.Q(project__isnull=True) |
+                models.Q(project_id=project_id),
+                obj_type=obj_type, name=name, searchable=True)
+    )
+    if not definitions:
+        raise ValueError('{} is not a searchable attribute of {}'.format(
+            name, model._meta.label))
+    numeric = [attr for attr in definitions if _numeric(attr)]
+    text = [attr for attr in definitions if not _numeric(attr)]
+    if prefix is not None and not text:
+        raise ValueError('{} is numeric and has no prefix search'.format(
+            name))
+    # (field, index into the search key, definitions) per kind of key.
+    kinds = [kind for kind in (('number_key', 1, numeric),
+                               ('text_key', 0, text)) if kind[2]]
+
+    def keys(index, defs, raw):
+        # Definitions for different subtypes may normalise differently.
+        found = [search_key(attr, raw) for attr in defs]
+        return set(k[index] for k in found if k)
+
+    for raw in (lower, upper):
+        if raw is not None and not any(keys(index, defs, raw)
+                                       for _, index, defs in kinds):
+            raise ValueError('invalid bound {!r} for {}'.format(raw, name))
+
+    def condition(field, index, defs):
+        # The conditions on one kind of key, or None if none of its
+        # entries can match.
+        q = models.Q()
+        if value is not None:
+            found = keys(index, defs, value)
+            if not found:
+                return None
+            q &= models.Q(**{field + '__in': found})
+        if prefix is not None:
+            if field != 'text_key':
+                return None
+            prefixes = models.Q()
+            for key in set(_prefix_key(attr, prefix) for attr in defs):
+                prefixes |= models.Q(text_key__startswith=key)
+            q &= prefixes
+        for raw, lookup, pick in ((lower, '__gte', min),
+                                  (upper, '__lte', max)):
+            if raw is not None:
+                found = keys(index, defs, raw)
+                if not found:
+                    return None
+                q &= models.Q(**{field + lookup: pick(found)})
+        return q
+
+    conditions = [c for c in (condition(*kind) for kind in kinds)
+                  if c is not None]
+    if not conditions:
+        return model.objects.none()
+    matches = conditions[0]
+    for c in conditions[1:]:
+        matches |= c
+    queryset = AttributeSearchKey.objects.filter(
+        matches, project_id=project_id, obj_type=obj_type, name=name
+    )
+    return model.objects.current().filter(
+        project_id=project_id,
+        id__in=queryset.values('obj_id')
+    )
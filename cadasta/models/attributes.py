@@ -1,33 +1,295 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
 from django.db.models import Model
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.fields import JSONField
 from bitemporal import bitemporal
 
+from . import instrumentation
 from .organization import Organization
 from .project import Project
+from .temporal import BitemporalManager, versions_saved, versions_closed
+from .validation import AttributeValidator
+
+
+# Shared (Django cache) counter bumped whenever any attribute
+# definition changes, so that every process drops its cached sets.
+GENERATION_KEY = 'attribute-set-generation'
+
+
+class AttributeSetCache(object):
+    """
+    In-process LRU cache of resolved attribute sets, keyed on
+    ``(organization_id, project_id, obj_type_id, obj_subtype)``.
+
+    Attribute definitions change very rarely compared to the rate at
+    which we validate attribute values, so it's worth merging the
+    system, organization and project layers once and hanging on to the
+    result.  Entries are dropped when any ``Attribute`` row that could
+    contribute to them is saved or deleted (see the signal handlers at
+    the bottom of this module).  Those handlers also bump a generation
+    counter in Django's cache: each process checks it at most every
+    ``check_interval`` seconds (and after every resolve) and empties
+    its cache when it has moved on, so changes made by other processes
+    are seen within that interval.
+
+    """
+    def __init__(self, name, maxsize=1024, check_interval=1.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped whenever entries are dropped, so that results resolved
+        # before an invalidation aren't stored after it.
+        self._generation = 0
+        self._shared = None
+        self._next_check = 0.0
+
+    def get(self, key, resolve):
+        """
+        Return the cached attribute set for ``key``, calling
+        ``resolve()`` to build it on a miss.
+        """
+        self._sync()
+        with self._lock:
+            hit = key in self._entries
+            if hit:
+                self.hits += 1
+                value = self._entries.pop(key)
+                self._entries[key] = value
+            else:
+                self.misses += 1
+            generation = self._generation
+        if hit:
+            instrumentation.incr('attributes.cache.hit', cache=self.name)
+            return value
+        instrumentation.incr('attributes.cache.miss', cache=self.name)
+
+        # Resolve outside the lock: it hits the database.  If the
+        # definitions changed meanwhile, the result may be stale, so
+        # it's returned but not kept.
+        value = resolve()
+        self._sync(force=True)
+        with self._lock:
+            if self._generation == generation:
+                self._entries[key] = value
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def _sync(self, force=False):
+        """
+        Empty the cache if the shared generation has changed.
+        """
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        shared = cache.get_or_set(GENERATION_KEY, 0, None)
+        with self._lock:
+            if shared != self._shared:
+                self._shared = shared
+                self._entries.clear()
+                self._generation += 1
+
+    def invalidate(self, organization_id, project_id,
+                   obj_type_id, obj_subtype):
+        """
+        Drop all cached entries that an attribute defined at the given
+        layer could contribute to.  A ``None`` organization or project,
+        or an empty subtype, is a default layer and so matches
+        everything below it.
+        """
+        def affected(key):
+            org, proj, ct, sub = key
+            return (ct == obj_type_id and
+                    organization_id in (None, org) and
+                    project_id in (None, proj) and
+                    obj_subtype in ('', sub))
+
+        with self._lock:
+            for key in [k for k in self._entries if affected(k)]:
+                del self._entries[key]
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+def bump_generation():
+    """
+    Tell every process that attribute definitions have changed, once
+    the current transaction commits.  Bumping any earlier would let a
+    reader cache the old definitions under the new generation.  This
+    process's caches are emptied again at the same point, for the same
+    reason.
+    """
+    def bump():
+        cache.add(GENERATION_KEY, 0, None)
+        cache.incr(GENERATION_KEY)
+        for attr_cache in (attribute_cache, validator_cache):
+            attr_cache.clear()
+
+    transaction.on_commit(bump)
 
 
-class AttributeManager(models.Manager):
+attribute_cache = AttributeSetCache('attribute_set')
+validator_cache = AttributeSetCache('validator')
+
+# Project ID -> organization ID.  Projects never move between
+# organizations, so this never needs invalidating.
+_organizations = {}
+
+
+def _organization_id(project_id):
+    if project_id is None:
+        return None
+    if project_id not in _organizations:
+        _organizations[project_id] = (
+            Project.objects.filter(pk=project_id)
+            .values_list('organization_id', flat=True).first()
+        )
+    return _organizations[project_id]
+
+
+class AttributeManager(BitemporalManager):
     """
-    Custom manager for attributes: just adds a filter to get the
+    Custom manager for attributes: just adds a method to get the
     allowed attribute set for a given object.
 
     """
     def attribute_set(self, obj):
         """
-        Filter queryset for the attributes associated with a particular
-        object.
+        Return the attribute set associated with a particular object,
+        as a tuple of ``Attribute`` instances ordered by index.
+
+        Attribute sets are layered: system defaults (organization=None,
+        project=None), then organization defaults (project=None), then
+        project-specific definitions.  Within each layer, definitions
+        for the object's subtype override those with an empty subtype.
+        Later layers override earlier ones by attribute name, and an
+        attribute with presence 'D' removes any earlier definition of
+        the same name.  Results are cached in ``attribute_cache``.
+        """
+        key = self._cache_key(obj)
+        return attribute_cache.get(key, lambda: self._resolve(*key))
+
+    def validator(self, obj):
+        """
+        Return a compiled ``AttributeValidator`` for the attribute set
+        associated with a particular object.  Validators are cached on
+        the same keys as attribute sets.
+        """
+        key = self._cache_key(obj)
+        return validator_cache.get(
+            key, lambda: AttributeValidator(
+                attribute_cache.get(key, lambda: self._resolve(*key))
+            )
+        )
+
+    def validate_many(self, objs, field='attributes'):
+        """
+        Validate the JSON attributes of many objects (parties, spatial
+        units, relationships, etc.) in one go, for bulk imports.  Each
+        distinct attribute set is compiled once.  Valid attribute dicts
+        are replaced by their normalised form; the return value is a
+        list of per-object error dicts, empty for valid objects.
+        """
+        validators = {}
+        related = {}
+        results = []
+        for obj in objs:
+            self._share_related(obj, related)
+            key = self._cache_key(obj)
+            validator = validators.get(key)
+            if validator is None:
+                validator = validators[key] = self.validator(obj)
+            normalised, errors = validator.check(getattr(obj, field))
+            if not errors:
+                setattr(obj, field, normalised)
+            results.append(errors)
+        return results
+
+    def _share_related(self, obj, related):
         """
-        project = getattr(obj, 'project', None)
+        Share the type objects used to build cache keys between
+        objects that refer to the same ones, so that bulk validation
+        doesn't fetch them once per object.
+        """
+        for name in ('type',):
+            try:
+                field = obj._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if not field.is_relation:
+                continue
+            key = (name, getattr(obj, field.attname))
+            if key in related:
+                setattr(obj, name, related[key])
+            else:
+                related[key] = getattr(obj, name)
+
+    def _cache_key(self, obj):
+        # Built from IDs, so that cache hits don't need any queries
+        # for the project or its organization.
+        project_id = getattr(obj, 'project_id', None)
+        organization_id = _organization_id(project_id)
         obj_type = ContentType.objects.get_for_model(obj)
-        obj_subtype = getattr(obj, 'type', '')
-        organization = getattr(project, 'organization', None)
-        # NOT QUITE RIGHT: NEEDS TO DEAL WITH DEFAULTING
-        # (organization=None, project=None) AND SUBTYPING.  SOMETHING
-        # LIKE THIS THOUGH...
-        return self.filter(organization=organization, project=project,
-                           obj_type=obj_type, obj_subtype=obj_subtype)
+        obj_subtype = getattr(obj, 'type', '') or ''
+        if isinstance(obj_subtype, Model):
+            # Tenure relationships have a foreign key to a type model
+            # rather than a choice field: use the type's short name.
+            obj_subtype = obj_subtype.name
+        return (organization_id, project_id, obj_type.pk, obj_subtype)
+
+    def _resolve(self, organization_id, project_id, obj_type_id, obj_subtype):
+        """
+        Merge the current versions of all the layers contributing to an
+        attribute set, using a single query.
+        """
+        with instrumentation.operation('attributes.resolve', self.model,
+                                       self.db) as op:
+            org_q = models.Q(organization__isnull=True)
+            if organization_id is not None:
+                org_q |= models.Q(organization_id=organization_id)
+            project_q = models.Q(project__isnull=True)
+            if project_id is not None:
+                project_q |= models.Q(project_id=project_id)
+            rows = self.current().filter(org_q, project_q,
+                                         obj_type_id=obj_type_id,
+                                         obj_subtype__in=('', obj_subtype))
+
+            def layer(attr):
+                return (attr.organization_id is not None,
+                        attr.project_id is not None,
+                        attr.obj_subtype != '')
+
+            merged = OrderedDict()
+            for attr in sorted(rows, key=layer):
+                if attr.presence == 'D':
+                    merged.pop(attr.name, None)
+                else:
+                    merged[attr.name] = attr
+            result = tuple(sorted(merged.values(), key=lambda a: a.index))
+            op.rows = len(result)
+        return result
 
 
 @bitemporal
@@ -56,7 +318,10 @@ class Attribute(Model):
      * a presence field saying whether the a value for the attribute
        is required or optional (the third "delete" option can be used
        to remove attributes defined for a particular object type for
-       selected subtypes).
+       selected subtypes);
+
+     * a searchable flag, saying whether normalised search keys are
+       kept for the attribute's values (see ``attribute_search``).
 
     """
     BASE_TYPE_CHOICES = (
@@ -73,10 +338,12 @@ class Attribute(Model):
 
     objects = AttributeManager()
 
-    organization = models.ForeignKey(Organization, on_delete=models.CASCADE)
-    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    organization = models.ForeignKey(Organization, on_delete=models.CASCADE,
+                                     null=True, blank=True)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE,
+                                null=True, blank=True)
     obj_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
-    obj_subtype = models.CharField(max_length=100)
+    obj_subtype = models.CharField(max_length=100, blank=True, default='')
 
     index = models.IntegerField()
     name = models.CharField(max_length=100)
@@ -85,12 +352,30 @@ class Attribute(Model):
     full_type = models.CharField(max_length=100)
     presence = models.CharField(max_length=1, choices=PRESENCE_CHOICES,
                                 default='O')
+    searchable = models.BooleanField(default=False)
 
     class Meta:
         index_together = ['organization', 'project', 'obj_type', 'obj_subtype']
         ordering = ['index']
 
 
+@receiver(post_save, sender=Attribute)
+@receiver(post_delete, sender=Attribute)
+def _invalidate_attribute_cache(sender, instance, **kwargs):
+    for attr_cache in (attribute_cache, validator_cache):
+        attr_cache.invalidate(instance.organization_id, instance.project_id,
+                              instance.obj_type_id, instance.obj_subtype)
+    bump_generation()
+
+
+@receiver(versions_saved, sender=Attribute)
+@receiver(versions_closed, sender=Attribute)
+def _clear_attribute_cache(sender, **kwargs):
+    for attr_cache in (attribute_cache, validator_cache):
+        attr_cache.clear()
+    bump_generation()
+
+
 class JSONAttributesField(JSONField):
     """
     This is just like a normal ``JSONField`` field except that it is
@@ -98,18 +383,23 @@ class JSONAttributesField(JSONField):
     ``Attribute`` model defined above to validate assignments to elements
     of that object.
 
-    The way this is supposed to work is as follows:
-
-    When you first attempt to assign to a member of a
-    ``JSONAttributesField``, the class of which the field is a member
-    is used to determine a project (from the class's ``project`` field
+    Validation happens when the field is cleaned (e.g. from
+    ``Model.full_clean``): the model instance the field belongs to is
+    used to determine a project (from the instance's ``project`` field
     if it has one), content type (from the class) and model subtype
-    (from the object's ``type`` field if it has one).  These values are
-    used to look up an attribute set, and this is then used to handle
-    validation of assignments to the JSON field.
+    (from the instance's ``type`` field if it has one).  These values
+    are used to look up a compiled validator for the corresponding
+    attribute set, which checks presence and types and normalises the
+    values of the JSON object.  For bulk imports, use
+    ``Attribute.objects.validate_many`` instead.
 
     """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('default', dict)
+        super(JSONAttributesField, self).__init__(*args, **kwargs)
 
-    # NOT SURE HOW TO IMPLEMENT THIS YET...
-    def something_something_something(self, obj):
-        self.attrs = Attribute.objects.attribute_set(obj)
+    def clean(self, value, model_instance):
+        value = super(JSONAttributesField, self).clean(value, model_instance)
+        if model_instance is None:
+            return value
+        return Attribute.objects.validator(model_instance).validate(value)
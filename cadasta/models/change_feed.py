@@ -0,0 +1,169 @@
+import base64
+import heapq
+import itertools
+import json
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .party import Party, PartyRelationship
+from .spatial_unit import SpatialUnit, SpatialUnitRelationship
+from .tenure_relationship import TenureRelationship
+from .resource import Resource
+from .temporal import ASSERT_FROM, ASSERT_TO, EFFECTIVE_FROM, EFFECTIVE_TO
+
+
+# Change feed for downstream sync (mobile clients, search indexing),
+# built on assert time: every write asserts new versions and/or
+# retracts old ones at a single assert time, so "what changed since T"
+# is a range scan over assert_from and assert_to.  Changes are grouped
+# per (assert time, model, entity ID), which is also the sort order and
+# the position recorded in the opaque cursor.
+#
+# Assert times are taken when a write starts, not when it commits, so
+# a slow transaction can commit versions asserted before a position a
+# client has already paged past.  To avoid missing those, the feed only
+# serves changes asserted at least ``SAFETY_LAG`` ago: pages are stable
+# as long as no write transaction runs longer than that (and the
+# application servers' clocks agree to within it).  Raise the lag if
+# long-running imports write to feed models.
+#
+# Each change is classified as:
+#
+#  * new -- an open-ended version asserted with nothing retracted;
+#  * updated -- an open-ended version replacing a retracted one;
+#  * corrected -- like updated, but back-dated (the new version's
+#    effective time starts before its assert time);
+#  * closed -- versions retracted with no open-ended replacement.
+
+FEED_MODELS = (Party, SpatialUnit, TenureRelationship, PartyRelationship,
+               SpatialUnitRelationship, Resource)
+
+SAFETY_LAG = timedelta(minutes=1)
+
+NEW = 'new'
+UPDATED = 'updated'
+CORRECTED = 'corrected'
+CLOSED = 'closed'
+
+
+def change_feed_index_sql(model, table=None):
+    """
+    SQL for the assert time indexes used by the change feed, for use
+    in a ``RunSQL`` migration.  ``table`` overrides the model's table
+    (e.g. for its archive table).
+    """
+    table = table or model._meta.db_table
+    return [
+        'CREATE INDEX "{0}_feed_asserted" ON "{0}" '
+        '("project_id", "{1}", "id")'.format(table, ASSERT_FROM),
+        'CREATE INDEX "{0}_feed_retracted" ON "{0}" '
+        '("project_id", "{1}", "id") WHERE "{1}" IS NOT NULL'.format(
+            table, ASSERT_TO),
+    ]
+
+
+def encode_cursor(position):
+    timestamp, label, entity_id = position
+    data = json.dumps([timestamp.isoformat(), label, entity_id])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    timestamp, label, entity_id = json.loads(
+        base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    )
+    return parse_datetime(timestamp), label, entity_id
+
+
+def _after(field, position, label):
+    """
+    Filter for rows whose (field, model label, id) key sorts after the
+    cursor position.
+    """
+    if position is None:
+        return Q(**{field + '__isnull': False})
+    timestamp, cursor_label, cursor_id = position
+    if label < cursor_label:
+        return Q(**{field + '__gt': timestamp})
+    if label > cursor_label:
+        return Q(**{field + '__gte': timestamp})
+    return (Q(**{field + '__gt': timestamp}) |
+            Q(**{field: timestamp, 'id__gt': cursor_id}))
+
+
+def _events(model, project, field, position, horizon, limit):
+    """
+    Up to ``limit`` (key, field, version) events for one model and one
+    side (assertions or retractions) up to ``horizon``, in key order.
+    Returns the events and whether the query was truncated.
+    """
+    label = model._meta.label_lower
+    rows = list(model.objects.filter(_after(field, position, label),
+                                     project=project,
+                                     **{field + '__lte': horizon})
+                .order_by(field, 'id')[:limit])
+    events = [((getattr(row, field), label, row.id), field, row)
+              for row in rows]
+    return events, len(rows) == limit
+
+
+def changes(project, cursor=None, limit=500, models=FEED_MODELS,
+            lag=SAFETY_LAG):
+    """
+    Changes to a project after ``cursor`` (from the start if None), as
+    a ``(changes, next_cursor)`` pair.  Each change is a dict with the
+    model label, entity ID, kind, assert time and the new current
+    version (None for closed entities).  Changes asserted less than
+    ``lag`` ago are held back (see ``SAFETY_LAG``).  Pass
+    ``next_cursor`` back to get the next page; it's the same cursor if
+    there's nothing new.
+    """
+    position = decode_cursor(cursor)
+    horizon = timezone.now() - lag
+    fetch = limit * 4
+    streams = []
+    boundary = None
+    for model in models:
+        for field in (ASSERT_FROM, ASSERT_TO):
+            events, truncated = _events(model, project, field, position,
+                                        horizon, fetch)
+            streams.append(events)
+            if truncated and (boundary is None or events[-1][0] < boundary):
+                boundary = events[-1][0]
+
+    result = []
+    merged = heapq.merge(*streams, key=lambda event: event[0])
+    for key, group in itertools.groupby(merged, key=lambda event: event[0]):
+        # Groups at or past the first truncation point may be missing
+        # rows: leave them for the next page.
+        if len(result) >= limit or (boundary is not None and key >= boundary
+                                    and result):
+            break
+        result.append(_classify(key, list(group)))
+        position = key
+
+    next_cursor = encode_cursor(position) if position else cursor
+    return result, next_cursor
+
+
+def _classify(key, events):
+    timestamp, label, entity_id = key
+    asserted = [row for _, field, row in events if field == ASSERT_FROM]
+    retracted = [row for _, field, row in events if field == ASSERT_TO]
+    current = [row for row in asserted if getattr(row, EFFECTIVE_TO) is None]
+    version = current[0] if current else None
+    if version is None:
+        kind = CLOSED if retracted else UPDATED
+    elif not retracted:
+        kind = NEW
+    elif getattr(version, EFFECTIVE_FROM) < timestamp:
+        kind = CORRECTED
+    else:
+        kind = UPDATED
+    return {'model': label, 'id': entity_id, 'kind': kind,
+            'timestamp': timestamp, 'version': version}
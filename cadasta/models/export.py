@@ -0,0 +1,275 @@
+import csv
+import itertools
+import json
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+from django.contrib.gis.db.models import GeometryField
+
+from .attributes import Attribute
+from .party import Party, PartyRelationship
+from .spatial_unit import SpatialUnit, SpatialUnitRelationship
+from .tenure_relationship import TenureRelationship, TenureRelationshipType
+from .resource import Resource
+from .temporal import EFFECTIVE_TO, ASSERT_TO
+
+
+# Project-wide data exports.  Current versions are streamed from the
+# database in fixed-size chunks (on PostgreSQL, ``QuerySet.iterator``
+# uses a server-side cursor), flattened into typed columns and handed
+# to one or more writers, so memory use depends on the chunk size and
+# not on the size of the project.
+#
+# JSON attributes are flattened into one column per attribute, named
+# "attributes.<name>", using the union of the resolved attribute sets
+# for all the subtypes of each model in the project.  Column types come
+# from the attributes' base types.  Attribute values that don't fit
+# their column's type (text in a number column, a fraction in an
+# integer column) are exported as nulls and counted in the report.
+
+EXPORT_MODELS = (Party, SpatialUnit, TenureRelationship,
+                 PartyRelationship, SpatialUnitRelationship, Resource)
+
+DTYPES = {'NO': 'float64', 'FR': 'float64', 'IN': 'int64', 'TX': 'string'}
+
+SKIPPED_FIELDS = ('attributes', 'project', EFFECTIVE_TO, ASSERT_TO)
+
+
+class Column(object):
+    def __init__(self, name, dtype, source=None, attribute=None):
+        self.name = name
+        self.dtype = dtype
+        self.source = source
+        self.attribute = attribute
+        self.invalid = 0
+
+    def value(self, row):
+        if self.attribute is None:
+            return row[self.source]
+        value = (row['attributes'] or {}).get(self.attribute)
+        if value is None:
+            return None
+        try:
+            if self.dtype == 'int64':
+                return _integer(value)
+            if self.dtype == 'float64':
+                return float(value)
+        except (TypeError, ValueError, OverflowError):
+            self.invalid += 1
+            return None
+        return str(value)
+
+
+def _integer(value):
+    """
+    An integer attribute value as an int.  Unlike ``int``, this doesn't
+    truncate fractions, and integer strings are parsed exactly.
+    """
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError('{} is not an integer'.format(value))
+    return int(value)
+
+
+class ExportReport(object):
+    def __init__(self):
+        self.rows = {}
+        self.invalid = {}
+
+    @property
+    def total_rows(self):
+        return sum(self.rows.values())
+
+
+def _subtype_instances(model, project):
+    """
+    Unsaved instances, one per subtype of ``model`` in use in the
+    project, to resolve attribute sets against.
+    """
+    if model is TenureRelationship:
+        types = (TenureRelationshipType.objects.current()
+                 .filter(project=project))
+        return [model(project=project, type=t) for t in types]
+    choices = getattr(model, 'TYPE_CHOICES', None)
+    if choices is not None:
+        subtypes = [code for code, _ in choices]
+    else:
+        subtypes = (model.objects.current().filter(project=project)
+                    .order_by().values_list('type', flat=True).distinct())
+    return [model(project=project, type=subtype) for subtype in subtypes]
+
+
+def columns(model, project):
+    """
+    The export columns for a model in a project: plain fields first,
+    then attribute columns in attribute index order.
+    """
+    cols = []
+    for field in model._meta.concrete_fields:
+        if field.name in SKIPPED_FIELDS:
+            continue
+        if isinstance(field, GeometryField):
+            dtype = 'geometry'
+        elif field.get_internal_type() in ('IntegerField', 'AutoField',
+                                           'PositiveIntegerField'):
+            dtype = 'int64'
+        elif field.get_internal_type() == 'DateTimeField':
+            dtype = 'datetime'
+        else:
+            dtype = 'string'
+        cols.append(Column(field.attname, dtype, source=field.attname))
+
+    attributes = {}
+    for obj in _subtype_instances(model, project):
+        for attr in Attribute.objects.attribute_set(obj):
+            attributes.setdefault(attr.name, attr)
+    for attr in sorted(attributes.values(), key=lambda a: a.index):
+        cols.append(Column('attributes.' + attr.name,
+                           DTYPES.get(attr.base_type, 'string'),
+                           attribute=attr.name))
+    return cols
+
+
+def chunks(model, project, cols, chunk_size):
+    """
+    Stream flattened rows of the current versions of a model in a
+    project, as lists of rows of at most ``chunk_size``.
+    """
+    sources = [c.source for c in cols if c.source] + ['attributes']
+    queryset = (model.objects.current().filter(project=project)
+                .order_by().values(*sources))
+    iterator = queryset.iterator()
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield [[c.value(row) for c in cols] for row in chunk]
+
+
+class CSVWriter(object):
+    extension = 'csv'
+
+    def __init__(self, path, cols):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([c.name for c in cols])
+        self.geometry = [i for i, c in enumerate(cols)
+                         if c.dtype == 'geometry']
+
+    def write(self, rows):
+        for row in rows:
+            for i in self.geometry:
+                if row[i] is not None:
+                    row[i] = row[i].wkt
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class GeoJSONWriter(object):
+    """
+    Writes a feature collection one feature at a time.  Models without
+    a geometry field give features with null geometries.
+    """
+    extension = 'geojson'
+
+    def __init__(self, path, cols):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.file.write('{"type": "FeatureCollection", "features": [\n')
+        self.names = [c.name for c in cols]
+        self.geometry = next((i for i, c in enumerate(cols)
+                              if c.dtype == 'geometry'), None)
+        self.first = True
+
+    def write(self, rows):
+        for row in rows:
+            geometry = None
+            if self.geometry is not None and row[self.geometry] is not None:
+                geometry = json.loads(row[self.geometry].geojson)
+            properties = dict((name, value)
+                              for i, (name, value)
+                              in enumerate(zip(self.names, row))
+                              if i != self.geometry)
+            if not self.first:
+                self.file.write(',\n')
+            self.first = False
+            json.dump({'type': 'Feature', 'geometry': geometry,
+                       'properties': properties}, self.file, default=str)
+
+    def close(self):
+        self.file.write('\n]}\n')
+        self.file.close()
+
+
+class ParquetWriter(object):
+    """
+    Columnar output: each chunk becomes a Parquet row group.  Needs
+    pyarrow.  Geometries are stored as WKB.
+    """
+    extension = 'parquet'
+
+    def __init__(self, path, cols):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImproperlyConfigured('Parquet export requires pyarrow')
+        self.pa = pyarrow
+        types = {'int64': pyarrow.int64(), 'float64': pyarrow.float64(),
+                 'string': pyarrow.string(), 'geometry': pyarrow.binary(),
+                 'datetime': pyarrow.timestamp('us', tz='UTC')}
+        self.cols = cols
+        self.schema = pyarrow.schema([(c.name, types[c.dtype]) for c in cols])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        arrays = []
+        for i, col in enumerate(self.cols):
+            values = [row[i] for row in rows]
+            if col.dtype == 'geometry':
+                values = [None if v is None else bytes(v.wkb) for v in values]
+            elif col.dtype == 'string':
+                values = [None if v is None else str(v) for v in values]
+            arrays.append(self.pa.array(values,
+                                        type=self.schema.field(i).type))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays,
+                                                          schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'csv': CSVWriter, 'geojson': GeoJSONWriter,
+           'parquet': ParquetWriter}
+
+
+def export_project(project, directory, formats=('csv', 'geojson'),
+                   chunk_size=5000, models=EXPORT_MODELS):
+    """
+    Export the current state of a project into ``directory``, with one
+    file per model and format (e.g. ``spatialunit.geojson``).  Returns
+    an ``ExportReport`` with the row counts per model name, and the
+    numbers of attribute values per column (as "<model>.<column>")
+    that didn't fit their column type and were exported as nulls.
+    """
+    report = ExportReport()
+    for model in models:
+        cols = columns(model, project)
+        name = model._meta.model_name
+        writers = [WRITERS[fmt](os.path.join(directory, name + '.' +
+                                             WRITERS[fmt].extension), cols)
+                   for fmt in formats]
+        report.rows[name] = 0
+        try:
+            for rows in chunks(model, project, cols, chunk_size):
+                report.rows[name] += len(rows)
+                for writer in writers:
+                    # CSV output converts geometries in place.
+                    writer.write([list(row) for row in rows])
+        finally:
+            for writer in writers:
+                writer.close()
+        for col in cols:
+            if col.invalid:
+                report.invalid[name + '.' + col.name] = col.invalid
+    return report
@@ -0,0 +1,379 @@
+import bisect
+import logging
+import socket
+import threading
+import time
+
+from django.apps import apps
+from django.db import connections
+
+
+# Instrumentation for the bitemporal write paths, temporal foreign key
+# resolution and attribute set lookups.  Code on those paths reports
+# counters (``incr``) and timed operations (``operation``), and these
+# are handed to whatever exporters have been enabled:
+#
+#     from cadasta.models import instrumentation
+#     memory = instrumentation.MemoryExporter()
+#     instrumentation.enable(memory, instrumentation.StatsdExporter())
+#
+# Each operation reports a count, a latency (in milliseconds), the
+# number of database queries issued and optionally the number of rows
+# involved, tagged with the model and whether it succeeded.  Operation
+# names used are:
+#
+#  * temporal.insert -- new versions written (``save``, ``bulk_save``);
+#  * temporal.close -- current versions closed (``bulk_close``);
+#  * temporal.delete -- per-object temporal deletes;
+#  * temporal_fk.prefetch -- one batched temporal foreign key join
+#    (rows are the instances resolved);
+#  * attributes.resolve -- attribute set resolution on a cache miss;
+#
+# plus attributes.cache.hit and attributes.cache.miss counters.
+#
+# Nothing is enabled by default.  When disabled, ``incr`` loops over
+# an empty tuple and ``operation`` returns a shared do-nothing context
+# manager, and the per-object save and delete methods aren't wrapped
+# at all, so the cost is a function call or two.
+
+# Latency histogram bucket upper bounds, in milliseconds.
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_exporters = ()
+
+
+def enabled():
+    return bool(_exporters)
+
+
+def enable(*exporters):
+    """
+    Send metrics to the given exporters (replacing any enabled
+    before).
+    """
+    global _exporters
+    _exporters = tuple(exporters)
+    for model in apps.get_models():
+        if _is_bitemporal(model):
+            _wrap_model(model)
+
+
+def disable():
+    global _exporters
+    _exporters = ()
+    for model in list(_wrapped):
+        _unwrap_model(model)
+
+
+def incr(name, value=1, **tags):
+    for exporter in _exporters:
+        exporter.counter(name, value, tags)
+
+
+def timing(name, ms, **tags):
+    for exporter in _exporters:
+        exporter.timing(name, ms, tags)
+
+
+class _CountingCursor(object):
+    """
+    Cursor wrapper counting the statements executed for an operation.
+    """
+    def __init__(self, cursor, operation):
+        self.cursor = cursor
+        self.operation = operation
+
+    def execute(self, *args, **kwargs):
+        self.operation.queries += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.operation.queries += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.cursor.__exit__(exc_type, exc_value, traceback)
+
+
+# Connection methods that wrap new database cursors (the second is
+# used instead of the first when queries are being logged).
+CURSOR_FACTORIES = ('make_cursor', 'make_debug_cursor')
+
+
+class Operation(object):
+    """
+    Context manager timing one operation and counting the queries it
+    issues.  Set ``rows`` inside the block to report a row count.
+
+    Queries are counted by wrapping the cursors the connection hands
+    out for the duration of the operation, so the count is exact and
+    nothing is added to the connection's query log.  Operations must
+    nest properly (as ``with`` blocks do).
+
+    """
+    def __init__(self, name, using=None, tags=None):
+        self.name = name
+        self.using = using or 'default'
+        self.tags = tags or {}
+        self.rows = None
+        self.queries = 0
+
+    def _wrap_factory(self, factory):
+        def make(*args, **kwargs):
+            return _CountingCursor(factory(*args, **kwargs), self)
+        return make
+
+    def __enter__(self):
+        self.connection = connections[self.using]
+        # Instance attributes shadowing the methods, if already wrapped
+        # by an enclosing operation.
+        self.saved = dict((name, self.connection.__dict__.get(name))
+                          for name in CURSOR_FACTORIES)
+        for name in CURSOR_FACTORIES:
+            setattr(self.connection, name,
+                    self._wrap_factory(getattr(self.connection, name)))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = (time.perf_counter() - self.start) * 1000
+        for name, saved in self.saved.items():
+            if saved is None:
+                delattr(self.connection, name)
+            else:
+                setattr(self.connection, name, saved)
+        tags = dict(self.tags, status='error' if exc_type else 'ok')
+        incr(self.name, **tags)
+        timing(self.name + '.latency', elapsed, **tags)
+        incr(self.name + '.queries', self.queries, **tags)
+        if self.rows is not None:
+            incr(self.name + '.rows', self.rows, **tags)
+        return False
+
+
+class _NullOperation(object):
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_OPERATION = _NullOperation()
+
+
+def operation(name, model=None, using=None, **tags):
+    """
+    Context manager instrumenting an operation, tagged with the
+    model's label if one is given.
+    """
+    if not _exporters:
+        return _NULL_OPERATION
+    if model is not None:
+        tags['model'] = model._meta.label_lower
+    return Operation(name, using, tags)
+
+
+# Per-object bitemporal saves and deletes happen inside the
+# ``bitemporal`` package, so while enabled the bitemporal models'
+# ``save`` and ``delete`` methods are wrapped in operations.  (Paired
+# pre/post signals can't be used: nothing is sent when a save fails.)
+
+_bitemporal_models = {}
+_wrapped = {}
+
+
+def _is_bitemporal(model):
+    from .temporal import EFFECTIVE_FROM
+    if model not in _bitemporal_models:
+        _bitemporal_models[model] = any(
+            f.name == EFFECTIVE_FROM for f in model._meta.concrete_fields
+        )
+    return _bitemporal_models[model]
+
+
+def _instrumented(name, model, method):
+    def wrapper(self, *args, **kwargs):
+        with operation(name, model, kwargs.get('using')):
+            return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def _wrap_model(model):
+    if model in _wrapped:
+        return
+    # Methods defined on the class itself, to put back on disable.
+    _wrapped[model] = (model.__dict__.get('save'),
+                       model.__dict__.get('delete'))
+    model.save = _instrumented('temporal.insert', model, model.save)
+    model.delete = _instrumented('temporal.delete', model, model.delete)
+
+
+def _unwrap_model(model):
+    for name, method in zip(('save', 'delete'), _wrapped.pop(model)):
+        if method is None:
+            delattr(model, name)
+        else:
+            setattr(model, name, method)
+
+
+def _tag_key(tags):
+    return tuple(sorted(tags.items()))
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the ``p``th percentile (the
+        maximum seen for the overflow bucket).
+        """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50), 'p95': self.percentile(95),
+                'p99': self.percentile(99), 'max': self.max}
+
+
+class MemoryExporter(object):
+    """
+    Keeps counters and latency histograms in memory, keyed on metric
+    name and tags, for tests, benchmarks and debugging views.
+
+    """
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, value, tags):
+        key = (name, _tag_key(tags))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def timing(self, name, ms, tags):
+        key = (name, _tag_key(tags))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].add(ms)
+
+    def value(self, name, **tags):
+        """
+        Total of a counter over all tag sets matching ``tags``.
+        """
+        wanted = set(tags.items())
+        with self._lock:
+            return sum(value for (n, key), value in self.counters.items()
+                       if n == name and wanted <= set(key))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [dict(name=name, tags=dict(key), value=value)
+                             for (name, key), value
+                             in sorted(self.counters.items())],
+                'histograms': [dict(h.as_dict(), name=name, tags=dict(key))
+                               for (name, key), h
+                               in sorted(self.histograms.items())],
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+class LogExporter(object):
+    """
+    Logs every metric, for development.
+
+    """
+    def __init__(self, logger='cadasta.instrumentation', level=logging.DEBUG):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def _tags(self, tags):
+        return ' '.join('{}={}'.format(k, v) for k, v in sorted(tags.items()))
+
+    def counter(self, name, value, tags):
+        self.logger.log(self.level, '%s +%s %s', name, value,
+                        self._tags(tags))
+
+    def timing(self, name, ms, tags):
+        self.logger.log(self.level, '%s %.3fms %s', name, ms,
+                        self._tags(tags))
+
+
+class StatsdExporter(object):
+    """
+    Sends metrics over UDP in statsd format to a local agent.  Plain
+    statsd has no tags, so they're appended to the metric name unless
+    ``dogstatsd`` is set, in which case they're sent as DogStatsD
+    ``|#tag:value`` tags.  Send errors are ignored: metrics must never
+    break the code being measured.
+
+    """
+    def __init__(self, host='127.0.0.1', port=8125, prefix='cadasta',
+                 dogstatsd=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.dogstatsd = dogstatsd
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, kind, tags):
+        name = '{}.{}'.format(self.prefix, name) if self.prefix else name
+        if self.dogstatsd:
+            line = '{}:{}|{}'.format(name, value, kind)
+            if tags:
+                line += '|#' + ','.join('{}:{}'.format(k, v)
+                                        for k, v in sorted(tags.items()))
+        else:
+            for key in sorted(tags):
+                name += '.' + str(tags[key]).replace('.', '_')
+            line = '{}:{}|{}'.format(name, value, kind)
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except OSError:
+            pass
+
+    def counter(self, name, value, tags):
+        self._send(name, value, 'c', tags)
+
+    def timing(self, name, ms, tags):
+        self._send(name, '{:.3f}'.format(ms), 'ms', tags)
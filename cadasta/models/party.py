@@ -3,7 +3,9 @@ from cadasta.core.models import RandomIDModel
 from bitemporal import bitemporal, TemporalForeignKey, TemporalManyToManyField
 
 from .project import Project
+from .temporal import BitemporalManager
 from .attributes import JSONAttributesField
+from .resource import ResourceAccessor
 
 
 @bitemporal
@@ -25,6 +27,8 @@ class Party(RandomIDModel):
                     (CORPORATION, 'Corporation'),
                     (GROUP,       'Group'))
 
+    objects = BitemporalManager()
+
     # All parties are associated with a single project.
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
 
@@ -40,6 +44,9 @@ class Party(RandomIDModel):
     # JSON attributes field with management of allowed members.
     attributes = JSONAttributesField()
 
+    # Resources attached to this object (see ResourceAccessor).
+    resources = ResourceAccessor()
+
     # Party-party relationships: includes things like family
     # relationships and group memberships.
     relationships = TemporalManyToManyField(
@@ -69,6 +76,8 @@ class PartyRelationship(RandomIDModel):
                     ('C', 'is-child-of'),
                     ('M', 'is-member-of'))
 
+    objects = BitemporalManager()
+
     # All party relationships are associated with a single project.
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
 
@@ -81,3 +90,6 @@ class PartyRelationship(RandomIDModel):
 
     # JSON attributes field with management of allowed members.
     attributes = JSONAttributesField()
+
+    # Resources attached to this object (see ResourceAccessor).
+    resources = ResourceAccessor()
@@ -0,0 +1,315 @@
+import threading
+from array import array
+from collections import deque
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .party import PartyRelationship
+from .tenure_relationship import TenureRelationship
+from .temporal import versions_saved, versions_closed
+
+
+# In-memory graph of the current party-party relationships in a
+# project, for household reconstruction and transitive group
+# membership without a query per hop.
+#
+# Relationships read "party1 <type> party2", so edges go from party1
+# to party2: a spouse or child points at their spouse or parent, and a
+# member points at its group.  The graph is loaded with one query into
+# compressed sparse row arrays (one for outgoing and one for incoming
+# edges).  Changes after loading go into a small overlay: removed
+# edges are flagged dead in place and added edges are kept in a dict
+# of lists, which is folded back into the arrays once it gets big.
+#
+# Each process keeps its own graphs, so every committed relationship
+# write also bumps a per-project version counter in Django's cache.  A
+# process applies its own writes to its graph in place; a graph whose
+# version has been moved on by another process is reloaded on next
+# use.
+
+SPOUSE = 'S'
+CHILD = 'C'
+MEMBER = 'M'
+
+FAMILY = frozenset([SPOUSE, CHILD])
+
+OUT = 'out'
+IN = 'in'
+BOTH = 'both'
+
+
+class PartyGraph(object):
+    def __init__(self, project_id, compact_ratio=0.1):
+        self.project_id = project_id
+        self.compact_ratio = compact_ratio
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """
+        (Re)load the graph from the database, with a single query.
+        """
+        # Read before loading, so writes made during the load cause
+        # another one.
+        self.version = _graph_version(self.project_id)
+        rows = (PartyRelationship.objects.current()
+                .filter(project_id=self.project_id)
+                .values_list('id', 'party1_id', 'party2_id', 'type'))
+        with self._lock:
+            self._ids = []
+            self._index = {}
+            self._edge_ids = []
+            self._src = array('i')
+            self._dst = array('i')
+            self._types = array('B')
+            for rel_id, party1, party2, rel_type in rows.iterator():
+                self._append_edge(rel_id, party1, party2, rel_type)
+            self._build()
+
+    def _node(self, party_id):
+        i = self._index.get(party_id)
+        if i is None:
+            i = self._index[party_id] = len(self._ids)
+            self._ids.append(party_id)
+        return i
+
+    def _append_edge(self, rel_id, party1, party2, rel_type):
+        self._edge_ids.append(rel_id)
+        self._src.append(self._node(party1))
+        self._dst.append(self._node(party2))
+        self._types.append(ord(rel_type))
+
+    def _build(self):
+        """
+        Build the CSR adjacency arrays from the live edges, dropping
+        dead ones and emptying the overlay.
+        """
+        live = [e for e, rel_id in enumerate(self._edge_ids)
+                if rel_id is not None]
+        self._edge_ids = [self._edge_ids[e] for e in live]
+        self._src = array('i', (self._src[e] for e in live))
+        self._dst = array('i', (self._dst[e] for e in live))
+        self._types = array('B', (self._types[e] for e in live))
+        self._edge_pos = dict((rel_id, e)
+                              for e, rel_id in enumerate(self._edge_ids))
+        self._out = _csr(len(self._ids), self._src)
+        self._in = _csr(len(self._ids), self._dst)
+        self._nbase = len(self._ids)
+        self._extra_out = {}
+        self._extra_in = {}
+        self._nextra = 0
+
+    def add(self, rel_id, party1, party2, rel_type):
+        with self._lock:
+            self.remove(rel_id)
+            e = len(self._edge_ids)
+            self._append_edge(rel_id, party1, party2, rel_type)
+            self._edge_pos[rel_id] = e
+            self._extra_out.setdefault(self._src[e], []).append(e)
+            self._extra_in.setdefault(self._dst[e], []).append(e)
+            self._nextra += 1
+            if self._nextra > self.compact_ratio * max(len(self._src), 1000):
+                self._build()
+
+    def remove(self, rel_id):
+        with self._lock:
+            e = self._edge_pos.pop(rel_id, None)
+            if e is not None:
+                self._edge_ids[e] = None
+
+    def _edges(self, i, direction):
+        """
+        Live edges (as (edge, neighbour) pairs) at node ``i``.
+        """
+        if direction in (OUT, BOTH):
+            for e in self._slice(self._out, self._extra_out, i):
+                yield e, self._dst[e]
+        if direction in (IN, BOTH):
+            for e in self._slice(self._in, self._extra_in, i):
+                yield e, self._src[e]
+
+    def _slice(self, csr, extra, i):
+        offsets, edges = csr
+        if i < self._nbase:
+            for k in range(offsets[i], offsets[i + 1]):
+                e = edges[k]
+                if self._edge_ids[e] is not None:
+                    yield e
+        for e in extra.get(i, ()):
+            if self._edge_ids[e] is not None:
+                yield e
+
+    def reachable(self, party_id, types, direction=BOTH, max_depth=None):
+        """
+        IDs of all parties reachable from ``party_id`` by following
+        relationships of the given types, not including the starting
+        party.
+        """
+        types = set(ord(t) for t in types)
+        with self._lock:
+            start = self._index.get(party_id)
+            if start is None:
+                return set()
+            seen = set([start])
+            queue = deque([(start, 0)])
+            while queue:
+                i, depth = queue.popleft()
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                for e, j in self._edges(i, direction):
+                    if j not in seen and self._types[e] in types:
+                        seen.add(j)
+                        queue.append((j, depth + 1))
+            seen.discard(start)
+            return set(self._ids[i] for i in seen)
+
+    def household(self, party_id):
+        """
+        The party plus everyone connected to them by spouse or child
+        relationships, in either direction.
+        """
+        return self.reachable(party_id, FAMILY) | set([party_id])
+
+    def group_members(self, group_id):
+        """
+        All members of a group, including members of member groups.
+        """
+        return self.reachable(group_id, (MEMBER,), direction=IN)
+
+    def groups(self, party_id):
+        """
+        All groups a party belongs to, directly or through other groups.
+        """
+        return self.reachable(party_id, (MEMBER,), direction=OUT)
+
+    def parcels_held(self, party_ids):
+        """
+        IDs of spatial units in current tenure relationships with any
+        of the given parties: one query, however many parties.
+        """
+        return set(TenureRelationship.objects.current()
+                   .filter(party_id__in=list(party_ids))
+                   .values_list('spatial_unit_id', flat=True))
+
+    def household_parcels(self, party_id):
+        return self.parcels_held(self.household(party_id))
+
+
+def _csr(nnodes, keys):
+    """
+    Compressed sparse row index: edges sorted by key node, with
+    offsets[i]:offsets[i + 1] the range of edges for node i.
+    """
+    offsets = array('i', [0]) * (nnodes + 1)
+    for k in keys:
+        offsets[k + 1] += 1
+    for i in range(nnodes):
+        offsets[i + 1] += offsets[i]
+    fill = array('i', offsets)
+    edges = array('i', [0]) * len(keys)
+    for e, k in enumerate(keys):
+        edges[fill[k]] = e
+        fill[k] += 1
+    return offsets, edges
+
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def _version_key(project_id):
+    return 'party-graph-version:{}'.format(project_id)
+
+
+def _graph_version(project_id):
+    return cache.get_or_set(_version_key(project_id), 0, None)
+
+
+def _bump_version(project_id):
+    """
+    Record a write to a project's relationships.  This process's graph
+    has had the write applied already, so it's kept current unless it
+    had missed an earlier write from elsewhere.
+    """
+    key = _version_key(project_id)
+    cache.add(key, 0, None)
+    version = cache.incr(key)
+    graph = _graphs.get(project_id)
+    if graph is not None and graph.version == version - 1:
+        graph.version = version
+
+
+def graph_for(project):
+    """
+    The party graph for a project, loaded on first use, kept up to
+    date by the relationship write hooks below and reloaded when
+    another process has written to the project's relationships.
+    """
+    project_id = getattr(project, 'pk', project)
+    version = _graph_version(project_id)
+    with _graphs_lock:
+        graph = _graphs.get(project_id)
+        if graph is None:
+            graph = _graphs[project_id] = PartyGraph(project_id)
+        elif graph.version != version:
+            graph.load()
+        return graph
+
+
+# The write hooks only touch the graphs and the shared versions once
+# the writer's transaction commits: applying a write that's then
+# rolled back would leave phantom edges, and bumping the version
+# before the commit could make another process reload without it.
+
+def _relationships_saved(rels):
+    edges = [(rel.project_id, rel.id, rel.party1_id, rel.party2_id,
+              rel.type) for rel in rels]
+
+    def apply():
+        for project_id, rel_id, party1, party2, rel_type in edges:
+            graph = _graphs.get(project_id)
+            if graph is not None:
+                graph.add(rel_id, party1, party2, rel_type)
+        for project_id in set(edge[0] for edge in edges):
+            _bump_version(project_id)
+
+    transaction.on_commit(apply)
+
+
+def _relationships_closed(ids, projects=None):
+    ids = list(ids)
+    if projects is None:
+        projects = list(PartyRelationship.objects.filter(id__in=ids)
+                        .values_list('project_id', flat=True).distinct())
+
+    def apply():
+        for graph in list(_graphs.values()):
+            for rel_id in ids:
+                graph.remove(rel_id)
+        for project_id in set(projects):
+            _bump_version(project_id)
+
+    transaction.on_commit(apply)
+
+
+@receiver(post_save, sender=PartyRelationship)
+def _relationship_saved(sender, instance, **kwargs):
+    _relationships_saved([instance])
+
+
+@receiver(post_delete, sender=PartyRelationship)
+def _relationship_deleted(sender, instance, **kwargs):
+    _relationships_closed([instance.id], [instance.project_id])
+
+
+@receiver(versions_saved, sender=PartyRelationship)
+def _bulk_relationships_saved(sender, instances, **kwargs):
+    _relationships_saved(instances)
+
+
+@receiver(versions_closed, sender=PartyRelationship)
+def _bulk_relationships_closed(sender, ids, **kwargs):
+    _relationships_closed(ids)
@@ -0,0 +1,289 @@
+from collections import Counter, defaultdict
+
+from django.db import connection, models, transaction
+from django.db.models import Count, Sum
+from django.db.models.signals import post_save, post_delete
+
+from .project import Project
+from .party import Party
+from .spatial_unit import SpatialUnit
+from .tenure_relationship import TenureRelationship, TenureRelationshipType
+from .temporal import (ASSERT_FROM, ASSERT_TO, EFFECTIVE_TO, closed_versions,
+                       versions_saved, versions_closed)
+
+
+# Per-project dashboard statistics: counts of parties by type, spatial
+# units by type (with their total area in square metres) and tenure
+# relationships by basic type (right, restriction, responsibility).
+#
+# These are maintained incrementally from the bitemporal write hooks
+# as append-only delta rows, summed per (kind, key) when read.  Writers
+# only ever insert, so concurrent writers to a project never wait on
+# each other's counter rows.  Reads compact a project's rows back down
+# to one per key once there are more than ``COMPACT_ROWS`` of them, so
+# dashboard reads stay a single small query.  ``rebuild`` recomputes
+# the statistics from scratch and reports any drift, holding an
+# exclusive advisory lock on the project that writers take in shared
+# mode, so no deltas are lost while it runs.
+
+PARTIES = 'party'
+SPATIAL_UNITS = 'spatial_unit'
+TENURE = 'tenure'
+
+# Spatial unit types counted in a project's total area.  Other types
+# (buildings, boundaries, extents...) overlap parcels, so counting them
+# too would count the same land more than once.
+AREA_TYPES = (SpatialUnit.PARCEL,)
+
+COMPACT_ROWS = 1000
+
+# Geometries sent per area query.
+AREA_BATCH_SIZE = 500
+
+# First key of the advisory locks on projects' statistics.
+LOCK_CLASS = 0x5747
+
+
+class ProjectStatistic(models.Model):
+    KIND_CHOICES = ((PARTIES,       'Parties'),
+                    (SPATIAL_UNITS, 'Spatial units'),
+                    (TENURE,        'Tenure relationships'))
+
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    key = models.CharField(max_length=16)
+    count = models.BigIntegerField(default=0)
+    area = models.FloatField(default=0)
+
+    class Meta:
+        index_together = ['project', 'kind', 'key']
+
+
+def project_statistics(project):
+    """
+    Dashboard statistics for a project, e.g.
+    ``{'party': {'IN': 120, 'GR': 4}, 'spatial_unit': {'PA': 97},
+    'tenure': {'RIGHT': 130}, 'area': 51234.5}``, where ``area`` is the
+    total area of the ``AREA_TYPES`` spatial units.
+    """
+    result = {PARTIES: {}, SPATIAL_UNITS: {}, TENURE: {}, 'area': 0.0}
+    rows = 0
+    for kind, key, count, area, n in (ProjectStatistic.objects
+                                      .filter(project=project)
+                                      .values_list('kind', 'key')
+                                      .annotate(Sum('count'), Sum('area'),
+                                                Count('id'))
+                                      .order_by()):
+        rows += n
+        if not count and not area:
+            continue
+        result[kind][key] = count
+        if kind == SPATIAL_UNITS and key in AREA_TYPES:
+            result['area'] += area
+    if rows > COMPACT_ROWS:
+        compact(project)
+    return result
+
+
+def apply_deltas(deltas):
+    """
+    Record ``{(project_id, kind, key): (count, area)}`` deltas, as new
+    delta rows.
+    """
+    with transaction.atomic():
+        for project_id in sorted(set(key[0] for key in deltas)):
+            _lock(project_id, shared=True)
+        ProjectStatistic.objects.bulk_create(
+            ProjectStatistic(project_id=project_id, kind=kind, key=key,
+                             count=count, area=area)
+            for (project_id, kind, key), (count, area) in deltas.items()
+            if count or area
+        )
+
+
+def compact(project):
+    """
+    Replace a project's delta rows with one row per (kind, key).  Rows
+    inserted concurrently are left alone, so this is safe to run at any
+    time.
+    """
+    table = connection.ops.quote_name(ProjectStatistic._meta.db_table)
+    sql = ('WITH moved AS (DELETE FROM {0} WHERE "project_id" = %s '
+           'RETURNING "kind", "key", "count", "area") '
+           'INSERT INTO {0} ("project_id", "kind", "key", "count", "area") '
+           'SELECT %s, "kind", "key", sum("count"), sum("area") '
+           'FROM moved GROUP BY "kind", "key"').format(table)
+    project_id = getattr(project, 'pk', project)
+    with transaction.atomic():
+        _lock(project_id, shared=True)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [project_id, project_id])
+
+
+def _areas(spatial_units):
+    """
+    Geodesic areas (m^2) of the geometries of some spatial unit
+    versions, keyed on ID, computed a batch at a time.
+    """
+    rows = [(su.id, bytes(su.geometry.ewkb)) for su in spatial_units
+            if su.geometry is not None]
+    areas = {}
+    for start in range(0, len(rows), AREA_BATCH_SIZE):
+        batch = rows[start:start + AREA_BATCH_SIZE]
+        sql = ('SELECT v.id, ST_Area(ST_GeomFromEWKB(v.geom)::geography) '
+               'FROM (VALUES {}) AS v(id, geom)').format(
+            ', '.join(['(%s, %s)'] * len(batch)))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [value for row in batch for value in row])
+            areas.update(cursor.fetchall())
+    return areas
+
+
+def _tenure_types(rels):
+    ids = set(rel.type_id for rel in rels)
+    return dict(TenureRelationshipType.objects.current()
+                .filter(id__in=ids).values_list('id', 'type'))
+
+
+def _deltas(model, new, old):
+    """
+    Statistic deltas for new versions (a list) replacing old versions
+    (a dict keyed on ID, including entities closed with no new
+    version).
+    """
+    deltas = defaultdict(lambda: [0, 0.0])
+    if model is SpatialUnit:
+        new_areas = _areas(new)
+        old_areas = _areas(old.values())
+    if model is TenureRelationship:
+        types = _tenure_types(list(new) + list(old.values()))
+
+    def add(obj, sign):
+        if model is Party:
+            key = (obj.project_id, PARTIES, obj.type)
+        elif model is SpatialUnit:
+            key = (obj.project_id, SPATIAL_UNITS, obj.type)
+            areas = new_areas if sign > 0 else old_areas
+            deltas[key][1] += sign * areas.get(obj.id, 0.0)
+        else:
+            key = (obj.project_id, TENURE, types.get(obj.type_id, ''))
+        deltas[key][0] += sign
+
+    for obj in new:
+        add(obj, 1)
+    for obj in old.values():
+        add(obj, -1)
+    return deltas
+
+
+def _record(model, new, old):
+    apply_deltas(_deltas(model, new, old))
+
+
+STATISTICS_MODELS = (Party, SpatialUnit, TenureRelationship)
+
+
+def _saved(sender, instance, **kwargs):
+    timestamp = getattr(instance, ASSERT_FROM)
+    _record(sender, [instance],
+            closed_versions(sender, [instance.id], timestamp))
+
+
+def _deleted(sender, instance, **kwargs):
+    _record(sender, [], {instance.id: instance})
+
+
+def _bulk_saved(sender, instances, timestamp, **kwargs):
+    _record(sender, instances,
+            closed_versions(sender, [obj.id for obj in instances], timestamp))
+
+
+def _bulk_closed(sender, ids, timestamp, **kwargs):
+    _record(sender, [], closed_versions(sender, ids, timestamp))
+
+
+for _model in STATISTICS_MODELS:
+    post_save.connect(_saved, sender=_model)
+    post_delete.connect(_deleted, sender=_model)
+    versions_saved.connect(_bulk_saved, sender=_model)
+    versions_closed.connect(_bulk_closed, sender=_model)
+
+
+def compute(project):
+    """
+    Compute a project's statistics from scratch, as
+    ``{(kind, key): (count, area)}``.
+    """
+    stats = {}
+    for party_type, count in (Party.objects.current()
+                              .filter(project=project)
+                              .values_list('type').annotate(n=Count('id'))
+                              .order_by()):
+        stats[(PARTIES, party_type)] = (count, 0.0)
+
+    sql = ('SELECT "type", count(*), '
+           'coalesce(sum(ST_Area("geometry"::geography)), 0) '
+           'FROM "{table}" WHERE "project_id" = %s '
+           'AND "{effective_to}" IS NULL AND "{assert_to}" IS NULL '
+           'GROUP BY "type"').format(table=SpatialUnit._meta.db_table,
+                                     effective_to=EFFECTIVE_TO,
+                                     assert_to=ASSERT_TO)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [getattr(project, 'pk', project)])
+        for su_type, count, area in cursor.fetchall():
+            stats[(SPATIAL_UNITS, su_type)] = (count, area)
+
+    types = dict(TenureRelationshipType.objects.current()
+                 .filter(project=project).values_list('id', 'type'))
+    tenure = Counter()
+    for type_id, count in (TenureRelationship.objects.current()
+                           .filter(project=project)
+                           .values_list('type_id').annotate(n=Count('id'))
+                           .order_by()):
+        tenure[types.get(type_id, '')] += count
+    for key, count in tenure.items():
+        stats[(TENURE, key)] = (count, 0.0)
+    return stats
+
+
+def _lock(project_id, shared):
+    """
+    Take a transaction-level advisory lock on a project's statistics:
+    shared for writers recording deltas (so they don't block each
+    other), exclusive for ``rebuild``.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock{}(%s, %s)'.format(
+            '_shared' if shared else ''), [LOCK_CLASS, project_id])
+
+
+def rebuild(project, tolerance=1e-6):
+    """
+    Recompute a project's statistics and replace the stored ones,
+    returning the discrepancies found as ``{(kind, key): (stored,
+    computed)}``.  Areas within ``tolerance`` (relative) match.  The
+    recomputation happens under an exclusive lock, so writes can't slip
+    in between computing and storing.
+    """
+    project_id = getattr(project, 'pk', project)
+    with transaction.atomic():
+        _lock(project_id, shared=False)
+        computed = compute(project)
+        stored = dict(((kind, key), (count, area)) for kind, key, count, area
+                      in ProjectStatistic.objects.filter(project=project)
+                      .values_list('kind', 'key')
+                      .annotate(Sum('count'), Sum('area')).order_by())
+        diffs = {}
+        for key in set(stored) | set(computed):
+            old = stored.get(key, (0, 0.0))
+            new = computed.get(key, (0, 0.0))
+            if (old[0] != new[0] or
+                    abs(old[1] - new[1]) > tolerance * max(abs(new[1]), 1)):
+                diffs[key] = (old, new)
+        ProjectStatistic.objects.filter(project=project).delete()
+        ProjectStatistic.objects.bulk_create(
+            ProjectStatistic(project_id=project_id, kind=kind, key=key,
+                             count=count, area=area)
+            for (kind, key), (count, area) in computed.items()
+        )
+    return diffs
@@ -7,6 +7,7 @@ from bitemporal import bitemporal, TemporalForeignKey
 from cadasta.core.models import RandomIDModel
 
 from .project import Project
+from .temporal import BitemporalManager
 
 
 # This is all transcribed more or less verbatim from the SpatialDev
@@ -22,12 +23,13 @@ from .project import Project
 # want to extend the field types to include more geometry types, for
 # example, but there may be more that we could do.
 #
-# Further down the road, we'll want to add some models to represent
-# mapping from questionnaire data to the
-# party/spatial-unit/relationship models.
+# The mapping from questionnaire data to the
+# party/spatial-unit/relationship models is in questionnaire_mapping.
 
 @bitemporal
 class Questionnaire(Model):
+    objects = BitemporalManager()
+
     raw_form = JSONField()
     name = models.CharField(max_length=100)
     label = models.CharField(max_length=200)
@@ -39,6 +41,8 @@ class Questionnaire(Model):
 
 @bitemporal
 class QuestionSection(Model):
+    objects = BitemporalManager()
+
     name = models.CharField(max_length=100)
     label = models.CharField(max_length=200)
     publish = models.BooleanField(default=True)
@@ -47,6 +51,8 @@ class QuestionSection(Model):
 
 @bitemporal
 class QuestionGroup(Model):
+    objects = BitemporalManager()
+
     name = models.CharField(max_length=100)
     label = models.CharField(max_length=200)
     section = TemporalForeignKey(QuestionSection)
@@ -67,6 +73,8 @@ class Question(Model):
                     ('PH', 'photo'),
                     ('S1', 'select one'),
                     ('GE', 'geopoint'),
+                    ('GT', 'geotrace'),
+                    ('GS', 'geoshape'),
                     ('NO', 'note'),
                     ('IN', 'integer'),
                     ('DE', 'decimal'),
@@ -76,6 +84,8 @@ class Question(Model):
                     ('RE', 'repeat'),
                     ('GR', 'group'))
 
+    objects = BitemporalManager()
+
     name = models.CharField(max_length=100)
     label = models.CharField(max_length=200)
     type = models.CharField(max_length=2, choices=TYPE_CHOICES)
@@ -89,6 +99,8 @@ class Question(Model):
 
 @bitemporal
 class QuestionOption(Model):
+    objects = BitemporalManager()
+
     question = TemporalForeignKey(Question)
     name = models.CharField(max_length=100)
     label = models.CharField(max_length=200)
@@ -96,12 +108,16 @@ class QuestionOption(Model):
 
 @bitemporal
 class RawQuestionnaireData(RandomIDModel):
+    objects = BitemporalManager()
+
     questionnaire = TemporalForeignKey(Questionnaire)
     data = JSONField(null=True, default=dict())
 
 
 @bitemporal
 class QuestionRespondent(RandomIDModel):
+    objects = BitemporalManager()
+
     questionnaire = TemporalForeignKey(Questionnaire)
     uuid = models.UUIDField()
     ona_data_id = models.CharField(max_length=100)
@@ -109,6 +125,9 @@ class QuestionRespondent(RandomIDModel):
 
 @bitemporal
 class QuestionResponse(RandomIDModel):
+    objects = BitemporalManager()
+
     respondent = TemporalForeignKey(QuestionRespondent)
     question = TemporalForeignKey(Question)
-    answer = models.CharField(max_length=200)
+    # Geoshapes and free text answers can be long.
+    answer = models.TextField()
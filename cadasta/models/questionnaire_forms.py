@@ -0,0 +1,216 @@
+from collections import namedtuple
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from .questionnaire_data import (Questionnaire, QuestionSection, QuestionGroup,
+                                 Question, QuestionOption)
+from .temporal import versions_saved, versions_closed
+
+
+# Compiled questionnaire forms.  Walking Questionnaire -> QuestionSection
+# -> QuestionGroup -> Question -> QuestionOption through temporal
+# foreign keys costs a query per hop, so forms are compiled into an
+# immutable structure of named tuples, either from the normalised rows
+# (one query per model, so five in all) or from the questionnaire's raw
+# form JSON (no queries).  Compiled forms are plain picklable values,
+# so they can be shared through Django's cache and passed to worker
+# processes.  Cache entries are keyed on a per-questionnaire version
+# number that's bumped whenever any of the form models changes.
+
+FormOption = namedtuple('FormOption', 'id name label')
+FormSection = namedtuple('FormSection', 'id name label groups questions')
+FormGroup = namedtuple('FormGroup', 'id name label parent groups questions')
+CompiledForm = namedtuple('CompiledForm',
+                          'id name label sections groups questions by_name')
+
+
+class FormQuestion(namedtuple('FormQuestion',
+                              'id name label type section group options')):
+    __slots__ = ()
+
+    def has_options(self):
+        return self.type in ['S1', 'SA']
+
+
+FORM_TIMEOUT = 24 * 60 * 60
+
+
+def compile_form(questionnaire):
+    """
+    Compile the current form for a questionnaire from the normalised
+    rows, with one query per form model.
+    """
+    questionnaire_id = getattr(questionnaire, 'pk', questionnaire)
+    form = Questionnaire.objects.current().get(id=questionnaire_id)
+    sections = list(QuestionSection.objects.current()
+                    .filter(questionnaire_id=questionnaire_id).order_by('id'))
+    groups = list(QuestionGroup.objects.current()
+                  .filter(questionnaire_id=questionnaire_id).order_by('id'))
+    questions = list(Question.objects.current()
+                     .filter(questionnaire_id=questionnaire_id).order_by('id'))
+    options = {}
+    for option in (QuestionOption.objects.current()
+                   .filter(question_id__in=[q.id for q in questions])
+                   .order_by('id')):
+        options.setdefault(option.question_id, []).append(
+            FormOption(option.id, option.name, option.label)
+        )
+
+    compiled_questions = tuple(
+        FormQuestion(q.id, q.name, q.label, q.type, q.section_id, q.group_id,
+                     tuple(options.get(q.id, ())))
+        for q in questions
+    )
+
+    def children(items, attr, key):
+        return tuple(item.id for item in items if getattr(item, attr) == key)
+
+    compiled_groups = dict(
+        (g.id, FormGroup(g.id, g.name, g.label, g.parent_id,
+                         children(groups, 'parent_id', g.id),
+                         children(questions, 'group_id', g.id)))
+        for g in groups
+    )
+    compiled_sections = tuple(
+        FormSection(s.id, s.name, s.label,
+                    tuple(g.id for g in groups
+                          if g.section_id == s.id and g.parent_id is None),
+                    tuple(q.id for q in questions
+                          if q.section_id == s.id and q.group_id is None))
+        for s in sections
+    )
+    return CompiledForm(form.id, form.name, form.label, compiled_sections,
+                        compiled_groups, compiled_questions,
+                        dict((q.name, q) for q in compiled_questions))
+
+
+# Map from pyxform JSON question types to Question.TYPE_CHOICES codes.
+RAW_TYPES = dict((label, code) for code, label in Question.TYPE_CHOICES)
+RAW_TYPES.update({'select one': 'S1', 'select_one': 'S1',
+                  'select all that apply': 'SA', 'select_multiple': 'SA'})
+
+
+def compile_raw_form(questionnaire):
+    """
+    Compile a form from a questionnaire's raw (pyxform JSON) form
+    definition.  The result has no database IDs, so it's only useful
+    for rendering and validating by name.
+    """
+    raw = questionnaire.raw_form
+    groups = {}
+    questions = []
+
+    def walk(items, parent):
+        child_groups, child_questions = [], []
+        for item in items:
+            kind = item.get('type', '')
+            if kind in ('group', 'repeat'):
+                sub_groups, sub_questions = walk(item.get('children', []),
+                                                 item['name'])
+                groups[item['name']] = FormGroup(
+                    None, item['name'], _label(item), parent,
+                    sub_groups, sub_questions
+                )
+                child_groups.append(item['name'])
+                continue
+            options = tuple(FormOption(None, c['name'], _label(c))
+                            for c in item.get('children', ()))
+            questions.append(FormQuestion(
+                None, item['name'], _label(item), RAW_TYPES.get(kind, 'TX'),
+                None, parent, options
+            ))
+            child_questions.append(item['name'])
+        return tuple(child_groups), tuple(child_questions)
+
+    top_groups, top_questions = walk(raw.get('children', []), None)
+    section = FormSection(None, raw.get('name', ''), _label(raw),
+                          top_groups, top_questions)
+    return CompiledForm(questionnaire.id, questionnaire.name,
+                        questionnaire.label, (section,), groups,
+                        tuple(questions), dict((q.name, q) for q in questions))
+
+
+def _label(item):
+    label = item.get('label', item.get('title', ''))
+    if isinstance(label, dict):
+        # Multi-language label: pick any language consistently.
+        label = label[sorted(label)[0]] if label else ''
+    return label
+
+
+def get_form(questionnaire):
+    """
+    The compiled current form for a questionnaire, from the cache if
+    possible.
+    """
+    questionnaire_id = getattr(questionnaire, 'pk', questionnaire)
+    version = _form_version(questionnaire_id)
+    key = 'form:{}:{}'.format(questionnaire_id, version)
+    form = cache.get(key)
+    if form is None:
+        form = compile_form(questionnaire_id)
+        cache.set(key, form, FORM_TIMEOUT)
+    return form
+
+
+def _version_key(questionnaire_id):
+    return 'form-version:{}'.format(questionnaire_id)
+
+
+def _form_version(questionnaire_id):
+    return cache.get_or_set(_version_key(questionnaire_id), 0, None)
+
+
+def invalidate_form(questionnaire_id):
+    """
+    Move a questionnaire's form version on once the current transaction
+    commits, so a concurrent ``get_form`` can't cache the old form
+    under the new version.
+    """
+    key = _version_key(questionnaire_id)
+
+    def bump():
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+    transaction.on_commit(bump)
+
+
+def _questionnaire_ids(model, instances):
+    if model is Questionnaire:
+        return set(obj.id for obj in instances)
+    if model is QuestionOption:
+        return set(Question.objects.current()
+                   .filter(id__in=[obj.question_id for obj in instances])
+                   .values_list('questionnaire_id', flat=True))
+    return set(obj.questionnaire_id for obj in instances)
+
+
+FORM_MODELS = (Questionnaire, QuestionSection, QuestionGroup,
+               Question, QuestionOption)
+
+
+def _form_changed(sender, instances):
+    for questionnaire_id in _questionnaire_ids(sender, instances):
+        invalidate_form(questionnaire_id)
+
+
+def _form_row_changed(sender, instance, **kwargs):
+    _form_changed(sender, [instance])
+
+
+def _form_rows_saved(sender, instances, **kwargs):
+    _form_changed(sender, instances)
+
+
+def _form_rows_closed(sender, ids, **kwargs):
+    _form_changed(sender, sender.objects.filter(id__in=ids))
+
+
+for _model in FORM_MODELS:
+    post_save.connect(_form_row_changed, sender=_model)
+    post_delete.connect(_form_row_changed, sender=_model)
+    versions_saved.connect(_form_rows_saved, sender=_model)
+    versions_closed.connect(_form_rows_closed, sender=_model)
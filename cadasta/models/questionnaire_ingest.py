@@ -0,0 +1,248 @@
+import itertools
+import time
+from collections import Counter, OrderedDict
+
+from django.db import transaction
+
+from .questionnaire_data import (RawQuestionnaireData, QuestionRespondent,
+                                 QuestionResponse)
+from .questionnaire_forms import get_form
+from .temporal import derived_id
+
+
+# Streaming ingest of raw ODK submissions (RawQuestionnaireData) into
+# normalised QuestionRespondent/QuestionResponse rows.  The pipeline is
+# a chain of generators -- read raw submissions, parse each one against
+# a precomputed question lookup, group into batches, write each batch
+# with the bulk bitemporal write path -- so memory use is bounded by
+# the batch size, not by the number of submissions.
+#
+# IDs are derived from the submission UUID and question, so ingesting
+# the same submissions again only writes new versions of the rows that
+# changed, and closes responses that are no longer there (e.g. an
+# option deselected in a select-all question).
+
+# ODK metadata fields that aren't answers to questions.
+META_FIELDS = frozenset(['_id', '_uuid', '_submission_time', '_version',
+                         '_status', '_geolocation', '_attachments', '_tags',
+                         '_notes', '_xform_id_string', '_bamboo_dataset_id',
+                         '_submitted_by', 'formhub/uuid', 'meta/instanceID'])
+
+# Maximum number of individual error messages kept in a report.
+MAX_ERRORS = 100
+
+
+class QuestionLookup(object):
+    """
+    Name -> question and question -> option names lookup for a
+    questionnaire, built from its compiled form.  ODK submissions key
+    answers on slash-separated group paths, so questions are looked up
+    by the last path component.
+
+    """
+    def __init__(self, questionnaire):
+        form = get_form(questionnaire)
+        self.questions = form.by_name
+        self.options = dict((q.id, set(o.name for o in q.options))
+                            for q in form.questions if q.options)
+
+    def question(self, field):
+        return self.questions.get(field.rsplit('/', 1)[-1])
+
+
+class IngestReport(object):
+    def __init__(self):
+        self.submissions = 0
+        self.responses = 0
+        self.batches = 0
+        self.duplicate_respondents = 0
+        self.duplicate_responses = 0
+        self.unchanged = 0
+        self.closed = 0
+        self.unknown_fields = Counter()
+        self.errors = []
+        self.seconds = 0.0
+
+    @property
+    def rate(self):
+        """
+        Submissions ingested per second.
+        """
+        return self.submissions / self.seconds if self.seconds else 0.0
+
+    def error(self, message):
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(message)
+
+    def as_dict(self):
+        return {'submissions': self.submissions,
+                'responses': self.responses,
+                'batches': self.batches,
+                'duplicate_respondents': self.duplicate_respondents,
+                'duplicate_responses': self.duplicate_responses,
+                'unchanged': self.unchanged,
+                'closed': self.closed,
+                'unknown_fields': dict(self.unknown_fields),
+                'errors': list(self.errors),
+                'seconds': self.seconds,
+                'rate': self.rate}
+
+
+def raw_submissions(questionnaire):
+    """
+    Stream the JSON data of the current raw submissions for a
+    questionnaire.
+    """
+    queryset = (RawQuestionnaireData.objects.current()
+                .filter(questionnaire=questionnaire)
+                .values_list('data', flat=True))
+    for data in queryset.iterator():
+        if data:
+            yield data
+
+
+def submission_uuid(data):
+    uuid = data.get('_uuid') or data.get('meta/instanceID', '')
+    return uuid[len('uuid:'):] if uuid.startswith('uuid:') else uuid
+
+
+def parse(submissions, questionnaire, lookup, report):
+    """
+    Turn raw submissions into (respondent, responses) pairs of unsaved
+    model instances.
+    """
+    questionnaire_id = getattr(questionnaire, 'pk', questionnaire)
+    for data in submissions:
+        report.submissions += 1
+        uuid = submission_uuid(data)
+        if not uuid:
+            report.error('submission {} has no UUID'.format(data.get('_id')))
+            continue
+        respondent = QuestionRespondent(
+            id=derived_id('respondent', questionnaire_id, uuid),
+            questionnaire_id=questionnaire_id,
+            uuid=uuid, ona_data_id=str(data.get('_id', ''))
+        )
+        responses = []
+        for field, value in data.items():
+            if field in META_FIELDS:
+                continue
+            question = lookup.question(field)
+            if question is None:
+                report.unknown_fields[field] += 1
+                continue
+            for answer in _answers(question, value, lookup, report, uuid):
+                # Select-all questions have one response per option.
+                key = answer if question.type == 'SA' else ''
+                responses.append(QuestionResponse(
+                    id=derived_id('response', respondent.id, question.id, key),
+                    respondent_id=respondent.id, question_id=question.id,
+                    answer=answer
+                ))
+        yield respondent, responses
+
+
+def _answers(question, value, lookup, report, uuid):
+    """
+    Answers for a single question: select-all questions give one
+    response per chosen option.
+    """
+    if value is None or value == '':
+        return []
+    value = str(value)
+    if not question.has_options():
+        return [value]
+    answers = value.split() if question.type == 'SA' else [value]
+    options = lookup.options.get(question.id, set())
+    bad = [a for a in answers if a not in options]
+    if bad:
+        report.error('submission {}: invalid option(s) {} for {}'.format(
+            uuid, ', '.join(bad), question.name))
+    return [a for a in answers if a in options]
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def write(batch, report):
+    """
+    Write a batch of parsed submissions.  A respondent or response ID
+    can only be written once per bulk save, so duplicates within the
+    batch (the same submission twice, or two fields for the same
+    question) are dropped, the last one winning, and counted in the
+    report.  A duplicate submission replaces all of the earlier one's
+    responses.  Rows identical to their current versions are skipped,
+    and the respondents' current responses that weren't parsed again
+    are closed.
+    """
+    submissions = OrderedDict()
+    for respondent, responses in batch:
+        if respondent.id in submissions:
+            report.duplicate_respondents += 1
+            report.error('duplicate submission {}'.format(respondent.uuid))
+            del submissions[respondent.id]
+        submissions[respondent.id] = (respondent, responses)
+    respondents = [respondent for respondent, _ in submissions.values()]
+    responses = OrderedDict()
+    for _, rs in submissions.values():
+        for response in rs:
+            if response.id in responses:
+                report.duplicate_responses += 1
+                del responses[response.id]
+            responses[response.id] = response
+    responses = list(responses.values())
+    with transaction.atomic():
+        respondents = _changed_respondents(respondents)
+        current = dict(QuestionResponse.objects.current()
+                       .filter(respondent_id__in=list(submissions))
+                       .values_list('id', 'answer'))
+        changed = [r for r in responses if current.get(r.id) != r.answer]
+        kept = set(r.id for r in responses)
+        missing = [i for i in current if i not in kept]
+        QuestionRespondent.objects.bulk_save(respondents)
+        QuestionResponse.objects.bulk_save(changed)
+        if missing:
+            QuestionResponse.objects.bulk_close(missing)
+    report.batches += 1
+    report.responses += len(changed)
+    report.unchanged += len(responses) - len(changed)
+    report.closed += len(missing)
+
+
+def _changed_respondents(respondents):
+    """
+    The respondents whose current version differs from the one parsed
+    (or that have none).
+    """
+    current = dict(
+        (values[0], tuple(str(v) for v in values[1:]))
+        for values in QuestionRespondent.objects.current()
+        .filter(id__in=[r.id for r in respondents])
+        .values_list('id', 'questionnaire_id', 'uuid', 'ona_data_id')
+    )
+    return [r for r in respondents
+            if current.get(r.id) != (str(r.questionnaire_id), str(r.uuid),
+                                     r.ona_data_id)]
+
+
+def ingest(questionnaire, batch_size=500, submissions=None):
+    """
+    Ingest the raw submissions for a questionnaire (or the given
+    iterable of submission dicts), returning an ``IngestReport``.
+    """
+    report = IngestReport()
+    start = time.time()
+    lookup = QuestionLookup(questionnaire)
+    if submissions is None:
+        submissions = raw_submissions(questionnaire)
+    parsed = parse(submissions, questionnaire, lookup, report)
+    for batch in batches(parsed, batch_size):
+        write(batch, report)
+    report.seconds = time.time() - start
+    return report
@@ -0,0 +1,342 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.contrib.gis.geos import GEOSException, GEOSGeometry
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections, transaction
+
+from .attributes import Attribute
+from .party import Party
+from .spatial_unit import SpatialUnit
+from .tenure_relationship import TenureRelationship, TenureRelationshipType
+from .questionnaire_data import QuestionRespondent, QuestionResponse
+from .questionnaire_forms import get_form
+from .temporal import derived_id
+
+
+# Mapping from questionnaire responses to parties, spatial units and
+# tenure relationships.  A mapping is declared per questionnaire as a
+# dict giving, for each target, the question that populates each
+# field, with "attributes.<name>" for JSON attributes, e.g.
+#
+#   {'party': {'name': 'respondent_name',
+#              'type': 'party_type',
+#              'attributes.national_id': 'id_number'},
+#    'spatial_unit': {'geometry': 'parcel_location',
+#                     'type': 'parcel_type'},
+#    'tenure': {'type': 'tenure_type'}}
+#
+# Each respondent maps to (at most) one party, one spatial unit and a
+# tenure relationship between them; the tenure "type" is the name of a
+# TenureRelationshipType in the project.
+#
+# The mapping runs in two stages.  Workers in a process pool each take
+# a partition of respondents, read their responses and produce plain
+# dicts of field values.  The parent process then commits each
+# partition's rows with the bulk bitemporal write path, in one
+# transaction per partition.  IDs are derived from the respondent, and
+# rows whose current version already has the mapped values are
+# skipped, so re-running a failed or partial mapping is safe.
+
+TARGETS = {'party': Party, 'spatial_unit': SpatialUnit,
+           'tenure': TenureRelationship}
+
+
+class MappingSpec(object):
+    def __init__(self, spec):
+        unknown = set(spec) - set(TARGETS)
+        if unknown:
+            raise ValueError('unknown mapping targets: ' +
+                             ', '.join(sorted(unknown)))
+        self.spec = dict((target, dict(fields))
+                         for target, fields in spec.items())
+
+    def questions(self):
+        return set(q for fields in self.spec.values() for q in fields.values())
+
+    def apply(self, answers):
+        """
+        Map one respondent's answers (question name -> answer) to a
+        dict of field values per target.  Targets with no answers are
+        left out.
+        """
+        rows = {}
+        for target, fields in self.spec.items():
+            values = {}
+            attributes = {}
+            for field, question in fields.items():
+                if question not in answers:
+                    continue
+                if field.startswith('attributes.'):
+                    attributes[field[len('attributes.'):]] = answers[question]
+                else:
+                    values[field] = answers[question]
+            if values or attributes:
+                values['attributes'] = attributes
+                rows[target] = values
+        return rows
+
+
+# Question types holding ODK geometry answers, and the geometry each
+# gives (None to go by the answer: one point, an open trace or a closed
+# shape).
+GEOMETRY_TYPES = {'GE': None, 'GT': 'LINESTRING', 'GS': 'POLYGON'}
+
+
+def odk_geometry(value, kind=None):
+    """
+    Convert an ODK geopoint ("lat lon alt accuracy"), geotrace or
+    geoshape (semicolon-separated geopoints) answer to WKT: a point, a
+    line string or a polygon, given by ``kind`` or, if that's None, by
+    the number of points and whether they form a closed ring.  Raises
+    ValueError for malformed answers.
+    """
+    points = [p.split() for p in value.split(';') if p.strip()]
+    if not points or any(len(p) < 2 for p in points):
+        raise ValueError('malformed geometry answer {!r}'.format(value))
+    try:
+        coords = ['{!r} {!r}'.format(float(p[1]), float(p[0]))
+                  for p in points]
+    except ValueError:
+        raise ValueError('malformed geometry answer {!r}'.format(value))
+    if kind is None:
+        if len(coords) == 1:
+            kind = 'POINT'
+        elif len(coords) > 3 and coords[0] == coords[-1]:
+            kind = 'POLYGON'
+        else:
+            kind = 'LINESTRING'
+    if kind == 'POINT':
+        if len(coords) != 1:
+            raise ValueError('expected a single point')
+        return 'POINT({})'.format(coords[0])
+    if kind == 'LINESTRING':
+        if len(coords) < 2:
+            raise ValueError('a line needs at least two points')
+        return 'LINESTRING({})'.format(', '.join(coords))
+    if coords[0] != coords[-1]:
+        coords.append(coords[0])
+    if len(coords) < 4:
+        raise ValueError('a shape needs at least three points')
+    return 'POLYGON(({}))'.format(', '.join(coords))
+
+
+def map_partition(spec, questionnaire_id, respondent_ids):
+    """
+    Worker: map a partition of respondents, returning a list of
+    (respondent ID, rows, errors) triples, where errors are per-target
+    dicts of field errors for answers that couldn't be converted.
+    Runs in a child process, so it only takes and returns picklable
+    values.
+    """
+    spec = MappingSpec(spec)
+    wanted = spec.questions()
+    questions = [q for q in get_form(questionnaire_id).questions
+                 if q.name in wanted]
+    names = dict((q.id, q.name) for q in questions)
+    geo = dict((q.id, GEOMETRY_TYPES[q.type]) for q in questions
+               if q.type in GEOMETRY_TYPES)
+    multiple = set(q.id for q in questions if q.type == 'SA')
+
+    answers = dict((rid, {}) for rid in respondent_ids)
+    bad = dict((rid, {}) for rid in respondent_ids)
+    responses = (QuestionResponse.objects.current()
+                 .filter(respondent_id__in=respondent_ids,
+                         question_id__in=list(names))
+                 .values_list('respondent_id', 'question_id', 'answer'))
+    for rid, qid, answer in responses.iterator():
+        name = names[qid]
+        if qid in multiple:
+            # One response per chosen option.
+            answers[rid].setdefault(name, []).append(answer)
+            continue
+        if qid in geo:
+            try:
+                answer = odk_geometry(answer, geo[qid])
+            except ValueError as exc:
+                bad[rid][name] = str(exc)
+                continue
+        answers[rid][name] = answer
+    results = []
+    for rid in respondent_ids:
+        values = answers[rid]
+        for qid in multiple:
+            if names[qid] in values:
+                values[names[qid]] = ' '.join(sorted(values[names[qid]]))
+        rows = spec.apply(values)
+        errors = {}
+        for target, fields in spec.spec.items():
+            failed = dict((field, [bad[rid][question]])
+                          for field, question in fields.items()
+                          if question in bad[rid])
+            if failed:
+                errors[target] = failed
+                rows.pop(target, None)
+        results.append((rid, rows, errors))
+    return results
+
+
+def _init_worker():
+    # Connections inherited from the parent can't be shared.
+    connections.close_all()
+
+
+class MappingReport(object):
+    def __init__(self):
+        self.respondents = 0
+        self.written = dict((target, 0) for target in TARGETS)
+        self.unchanged = dict((target, 0) for target in TARGETS)
+        self.errors = {}
+
+
+def _field_errors(model, values):
+    """
+    Errors for the mapped (non-attribute) field values of one target,
+    checked against the model fields' choices, lengths and so on.
+    Relations (the tenure type, given by name) are resolved separately.
+    """
+    errors = {}
+    for name, value in values.items():
+        if name == 'attributes':
+            continue
+        try:
+            field = model._meta.get_field(name)
+            if field.is_relation:
+                continue
+            if name == 'geometry':
+                if value:
+                    GEOSGeometry(value, srid=4326)
+            else:
+                field.clean(value, None)
+        except FieldDoesNotExist:
+            errors[name] = ['unknown field']
+        except ValidationError as exc:
+            errors[name] = exc.messages
+        except (GEOSException, ValueError, TypeError) as exc:
+            errors[name] = [str(exc)]
+    return errors
+
+
+def commit(project, results, report):
+    """
+    Commit stage: build model instances for a partition's mapped rows,
+    validate their fields and attributes and write them in bulk.  Rows
+    that fail validation are reported and left out, along with tenure
+    relationships whose party or spatial unit was left out.  Errors are
+    reported per respondent, as ``{target: {field: [messages]}}``.
+    """
+    project_id = getattr(project, 'pk', project)
+    tenure_types = dict(TenureRelationshipType.objects.current()
+                        .filter(project_id=project_id)
+                        .values_list('name', 'id'))
+    objs = dict((target, []) for target in TARGETS)
+    # Derived entity ID -> respondent ID, for reporting.
+    respondents = {}
+
+    def error(rid, target, errors):
+        report.errors.setdefault(rid, {})[target] = errors
+
+    for rid, rows, errors in results:
+        report.respondents += 1
+        for target in TARGETS:
+            respondents[derived_id(target, rid)] = rid
+        for target, field_errors in errors.items():
+            error(rid, target, field_errors)
+        for target, values in rows.items():
+            field_errors = _field_errors(TARGETS[target], values)
+            if field_errors:
+                error(rid, target, field_errors)
+                rows[target] = None
+        party = rows.get('party')
+        su = rows.get('spatial_unit')
+        if party is not None:
+            objs['party'].append(Party(
+                id=derived_id('party', rid), project_id=project_id, **party
+            ))
+        if su is not None:
+            if su.get('geometry'):
+                su['geometry'] = GEOSGeometry(su['geometry'], srid=4326)
+            objs['spatial_unit'].append(SpatialUnit(
+                id=derived_id('spatial_unit', rid), project_id=project_id, **su
+            ))
+        tenure = rows.get('tenure')
+        if tenure is not None and party is not None and su is not None:
+            type_id = tenure_types.get(tenure.pop('type', None))
+            if type_id is None:
+                error(rid, 'tenure', {'type': ['unknown tenure type']})
+                continue
+            objs['tenure'].append(TenureRelationship(
+                id=derived_id('tenure', rid), project_id=project_id,
+                party_id=derived_id('party', rid),
+                spatial_unit_id=derived_id('spatial_unit', rid),
+                type_id=type_id, **tenure
+            ))
+
+    accepted = {}
+    with transaction.atomic():
+        for target in ('party', 'spatial_unit', 'tenure'):
+            model = TARGETS[target]
+            if target == 'tenure':
+                # The party and spatial unit must have been written
+                # (or already be current with the mapped values).
+                kept = []
+                for rel in objs[target]:
+                    if (rel.party_id in accepted['party'] and
+                            rel.spatial_unit_id in accepted['spatial_unit']):
+                        kept.append(rel)
+                    else:
+                        error(respondents[rel.id], target, {'__all__': [
+                            'party or spatial unit was not written'
+                        ]})
+                objs[target] = kept
+            valid = []
+            checked = Attribute.objects.validate_many(objs[target])
+            for obj, errors in zip(objs[target], checked):
+                if errors:
+                    error(respondents[obj.id], target, errors)
+                else:
+                    valid.append(obj)
+            accepted[target] = set(obj.id for obj in valid)
+            changed = _changed(model, valid)
+            report.unchanged[target] += len(valid) - len(changed)
+            model.objects.bulk_save(changed)
+            report.written[target] += len(changed)
+
+
+def _changed(model, objs):
+    """
+    The objects whose mapped values differ from their current version.
+    """
+    if not objs:
+        return []
+    fields = [f.attname for f in model._meta.concrete_fields
+              if f.name in ('name', 'type', 'geometry', 'attributes',
+                            'party', 'spatial_unit')]
+    current = dict((values[0], values[1:]) for values in
+                   model.objects.current()
+                   .filter(id__in=[obj.id for obj in objs])
+                   .values_list('id', *fields))
+    return [obj for obj in objs
+            if current.get(obj.id) != tuple(getattr(obj, f) for f in fields)]
+
+
+def run(questionnaire, project, spec, workers=4, partition_size=500):
+    """
+    Map all current respondents of a questionnaire, partitioned across
+    a pool of worker processes.  Returns a ``MappingReport``.
+    """
+    questionnaire_id = getattr(questionnaire, 'pk', questionnaire)
+    spec = MappingSpec(spec).spec
+    ids = list(QuestionRespondent.objects.current()
+               .filter(questionnaire_id=questionnaire_id)
+               .order_by('id').values_list('id', flat=True))
+    partitions = [ids[i:i + partition_size]
+                  for i in range(0, len(ids), partition_size)]
+
+    report = MappingReport()
+    connections.close_all()
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        futures = [pool.submit(map_partition, spec, questionnaire_id, part)
+                   for part in partitions]
+        for future in as_completed(futures):
+            commit(project, future.result(), report)
+    return report
@@ -9,9 +9,29 @@ from bitemporal import bitemporal, TemporalGenericForeignKey
 from cadasta.core.models import RandomIDModel, ID_FIELD_LENGTH
 
 from .project import Project
+from .temporal import ASSERT_TO, EFFECTIVE_TO, BitemporalQuerySet
 from .attributes import JSONAttributesField
 
 
+class ResourceQuerySet(BitemporalQuerySet):
+    def for_objects(self, objs):
+        """
+        Restrict to resources attached to any of the given objects,
+        which may be of different models: one query however many
+        objects, using the (obj_type, obj_id) index.
+        """
+        ids = {}
+        for obj in objs:
+            content_type = ContentType.objects.get_for_model(obj)
+            ids.setdefault(content_type.pk, set()).add(str(obj.id))
+        if not ids:
+            return self.none()
+        return self.filter(functools.reduce(operator.or_, [
+            models.Q(obj_type_id=ct, obj_id__in=obj_ids)
+            for ct, obj_ids in ids.items()
+        ]))
+
+
 @bitemporal
 class Resource(RandomIDModel):
     """
@@ -20,6 +40,8 @@ class Resource(RandomIDModel):
     organization).
     """
 
+    objects = models.Manager.from_queryset(ResourceQuerySet)()
+
     # Resources are associated with an individual project.
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
 
@@ -41,8 +63,9 @@ class Resource(RandomIDModel):
                    'spatial_unit', 'spatial_unit_relationship',
                    'tenure_relationship', 'organization', 'project',
                    'questionnaire', 'question']
-    limit = functools.reduce([models.Q(app_label='cadasta', model=m)
-                              for m in model_names], operator.or_)
+    limit = functools.reduce(operator.or_,
+                             [models.Q(app_label='cadasta', model=m)
+                              for m in model_names])
     obj_type = models.ForeignKey(ContentType,
                                  on_delete=models.CASCADE,
                                  limit_choices_to=limit)
@@ -50,5 +73,51 @@ class Resource(RandomIDModel):
     # The type of the obj_id field should match that of the primary
     # key of the target models.
     obj_id = models.CharField(max_length=ID_FIELD_LENGTH)
-    obj = TemporalGenericForeignKey('content_type', 'obj_id',
+    obj = TemporalGenericForeignKey('obj_type', 'obj_id',
                                     on_delete=bitemporal.CASCADE)
+
+    class Meta:
+        index_together = ['obj_type', 'obj_id']
+
+
+def resource_index_sql():
+    """
+    SQL for a partial index on the generic relation columns of current
+    resource versions, for use in a ``RunSQL`` migration.
+    """
+    return ('CREATE INDEX "{0}_current_obj" ON "{0}" '
+            '("obj_type_id", "obj_id") '
+            'WHERE "{1}" IS NULL AND "{2}" IS NULL'.format(
+                Resource._meta.db_table, EFFECTIVE_TO, ASSERT_TO))
+
+
+class ResourceAccessor(object):
+    """
+    Reverse accessor for the resources attached to an object: a list
+    of the current resources, prefetched for a whole page of objects
+    by ``prefetch_temporal('resources')`` or fetched on first access.
+
+    """
+    cache_name = '_resources_cache'
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return getattr(instance, self.cache_name)
+        except AttributeError:
+            self.prefetch([instance], None, None, None)
+            return getattr(instance, self.cache_name)
+
+    def prefetch(self, objs, effective, asserted, using):
+        queryset = (Resource.objects.db_manager(using)
+                    .as_of(effective, asserted).for_objects(objs))
+        by_obj = {}
+        for resource in queryset:
+            key = (resource.obj_type_id, resource.obj_id)
+            by_obj.setdefault(key, []).append(resource)
+        for obj in objs:
+            content_type = ContentType.objects.get_for_model(obj)
+            setattr(obj, self.cache_name,
+                    by_obj.get((content_type.pk, str(obj.id)), []))
+        return [r for rs in by_obj.values() for r in rs]
@@ -0,0 +1,213 @@
+from collections import Counter, defaultdict
+
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from cadasta.core.models import ID_FIELD_LENGTH
+
+from .project import Project
+from .spatial_unit import SpatialUnit, SpatialUnitRelationship
+from .temporal import (ASSERT_FROM, EFFECTIVE_FROM, closed_versions,
+                       versions_saved, versions_closed)
+
+
+# Closure table for the spatial unit relationship graphs, so that
+# questions like "all parcels inside this community boundary" or "the
+# full split/merge lineage of this parcel" are a single indexed query
+# instead of a recursive walk with a query per level.
+#
+# There are two graphs: containment (is-contained-in) and lineage
+# (is-split-of, is-merge-of).  In both, su2 is the ancestor of su1.
+# There is one closure row per *path* between two spatial units, which
+# is what makes incremental maintenance easy for lineage graphs, where
+# merges mean there can be more than one path between two units:
+# adding an edge p -> c adds a row for every (ancestor of p, descendant
+# of c) combination, and removing it closes the same rows.  Cycles
+# aren't handled (and shouldn't happen).
+#
+# Rows carry the effective time range over which the path existed, so
+# the closure can be queried as of an earlier time.  It's derived from
+# the current assertions of the relationships, so it doesn't keep the
+# history of corrections.
+
+CONTAINMENT = 'C'
+LINEAGE = 'L'
+
+EDGE_KINDS = {'C': CONTAINMENT, 'S': LINEAGE, 'M': LINEAGE}
+
+
+class SpatialUnitClosure(models.Model):
+    KIND_CHOICES = ((CONTAINMENT, 'Containment'),
+                    (LINEAGE,     'Lineage'))
+
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES)
+    ancestor_id = models.CharField(max_length=ID_FIELD_LENGTH)
+    descendant_id = models.CharField(max_length=ID_FIELD_LENGTH)
+    depth = models.PositiveIntegerField()
+    effective_from = models.DateTimeField()
+    effective_to = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = [['kind', 'ancestor_id', 'effective_to'],
+                          ['kind', 'descendant_id', 'effective_to']]
+
+
+def _paths(kind, effective=None, **filters):
+    queryset = SpatialUnitClosure.objects.filter(kind=kind, **filters)
+    if effective is None:
+        return queryset.filter(effective_to__isnull=True)
+    return queryset.filter(
+        models.Q(effective_to__isnull=True) |
+        models.Q(effective_to__gt=effective),
+        effective_from__lte=effective
+    )
+
+
+def descendants(su, kind=CONTAINMENT, effective=None, max_depth=None):
+    """
+    Spatial units below ``su`` in the containment (or lineage) graph,
+    as of ``effective`` (default: now).
+    """
+    paths = _paths(kind, effective, ancestor_id=getattr(su, 'id', su))
+    if max_depth is not None:
+        paths = paths.filter(depth__lte=max_depth)
+    ids = paths.values('descendant_id')
+    return SpatialUnit.objects.as_of(effective).filter(id__in=ids)
+
+
+def ancestors(su, kind=CONTAINMENT, effective=None, max_depth=None):
+    """
+    Spatial units above ``su`` in the containment (or lineage) graph,
+    as of ``effective`` (default: now).
+    """
+    paths = _paths(kind, effective, descendant_id=getattr(su, 'id', su))
+    if max_depth is not None:
+        paths = paths.filter(depth__lte=max_depth)
+    ids = paths.values('ancestor_id')
+    return SpatialUnit.objects.as_of(effective).filter(id__in=ids)
+
+
+def _combinations(kind, parent, child):
+    """
+    Count the paths that go through an edge parent -> child, keyed on
+    (ancestor, descendant, depth).
+    """
+    above = [(parent, 0)] + list(_paths(kind, descendant_id=parent)
+                                 .values_list('ancestor_id', 'depth'))
+    below = [(child, 0)] + list(_paths(kind, ancestor_id=child)
+                                .values_list('descendant_id', 'depth'))
+    return Counter((a, d, da + dd + 1) for a, da in above for d, dd in below)
+
+
+def add_edge(project_id, kind, parent, child, effective):
+    SpatialUnitClosure.objects.bulk_create(
+        SpatialUnitClosure(project_id=project_id, kind=kind,
+                           ancestor_id=a, descendant_id=d, depth=depth,
+                           effective_from=effective)
+        for (a, d, depth), n in _combinations(kind, parent, child).items()
+        for _ in range(n)
+    )
+
+
+def remove_edge(project_id, kind, parent, child, effective):
+    needed = _combinations(kind, parent, child)
+    candidates = _paths(kind, project_id=project_id,
+                        ancestor_id__in=set(a for a, _, _ in needed),
+                        descendant_id__in=set(d for _, d, _ in needed))
+    close = []
+    for pk, a, d, depth in candidates.values_list(
+            'pk', 'ancestor_id', 'descendant_id', 'depth'):
+        if needed[(a, d, depth)] > 0:
+            needed[(a, d, depth)] -= 1
+            close.append(pk)
+    SpatialUnitClosure.objects.filter(pk__in=close).update(
+        effective_to=effective
+    )
+
+
+def _edge(rel):
+    return (rel.project_id, EDGE_KINDS[rel.type], rel.su2_id, rel.su1_id)
+
+
+def _relationships_changed(new, old, effective):
+    """
+    Apply changes to the closure for new relationship versions (a list
+    of relationships) replacing old versions (a dict keyed on ID).
+    """
+    with transaction.atomic():
+        for rel in new:
+            prev = old.pop(rel.id, None)
+            if prev is not None and _edge(prev) == _edge(rel):
+                continue
+            if prev is not None:
+                remove_edge(*_edge(prev), effective=effective)
+            add_edge(*_edge(rel), effective=effective)
+        for prev in old.values():
+            remove_edge(*_edge(prev), effective=effective)
+
+
+def rebuild(project):
+    """
+    Rebuild the closure for a project from the current relationships,
+    e.g. to backfill it.  Past history is lost.  Raises ``ValueError``,
+    leaving the closure as it was, if the relationships contain a
+    cycle.
+    """
+    now = timezone.now()
+    children = defaultdict(lambda: defaultdict(list))
+    edges = (SpatialUnitRelationship.objects.current()
+             .filter(project=project)
+             .values_list('type', 'su2_id', 'su1_id'))
+    for rel_type, parent, child in edges:
+        children[EDGE_KINDS[rel_type]][parent].append(child)
+
+    rows = []
+    for kind, graph in children.items():
+        for root in graph:
+            # Each stack entry carries the path from the root to it, so
+            # a cycle in bad data is reported rather than walked forever.
+            stack = [(child, (root,)) for child in graph[root]]
+            while stack:
+                node, path = stack.pop()
+                if node in path:
+                    raise ValueError('{} cycle: {}'.format(
+                        kind, ' -> '.join(str(n) for n in path + (node,))
+                    ))
+                rows.append(SpatialUnitClosure(
+                    project_id=getattr(project, 'pk', project), kind=kind,
+                    ancestor_id=root, descendant_id=node, depth=len(path),
+                    effective_from=now
+                ))
+                stack.extend((child, path + (node,))
+                             for child in graph.get(node, ()))
+
+    with transaction.atomic():
+        SpatialUnitClosure.objects.filter(project=project).delete()
+        SpatialUnitClosure.objects.bulk_create(rows, batch_size=1000)
+
+
+@receiver(post_save, sender=SpatialUnitRelationship)
+def _relationship_saved(sender, instance, **kwargs):
+    old = closed_versions(sender, [instance.id],
+                          getattr(instance, ASSERT_FROM))
+    _relationships_changed([instance], old, getattr(instance, EFFECTIVE_FROM))
+
+
+@receiver(post_delete, sender=SpatialUnitRelationship)
+def _relationship_deleted(sender, instance, **kwargs):
+    _relationships_changed([], {instance.id: instance}, timezone.now())
+
+
+@receiver(versions_saved, sender=SpatialUnitRelationship)
+def _relationships_saved(sender, instances, timestamp, effective, **kwargs):
+    old = closed_versions(sender, [rel.id for rel in instances], timestamp)
+    _relationships_changed(instances, old, effective)
+
+
+@receiver(versions_closed, sender=SpatialUnitRelationship)
+def _relationships_closed(sender, ids, timestamp, effective, **kwargs):
+    _relationships_changed([], closed_versions(sender, ids, timestamp),
+                           effective)
@@ -0,0 +1,159 @@
+import json
+import math
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .spatial_unit import SpatialUnit
+from .temporal import ASSERT_TO, EFFECTIVE_TO, versions_saved, versions_closed
+
+
+# Map viewport and tile queries over spatial units.  Only current
+# versions are ever drawn, so these queries use a partial spatial
+# index restricted to current versions (see ``spatial_index_sql``)
+# rather than the full index over every historical geometry.  Rendered
+# tiles are cached, keyed on a per-project version number that's
+# bumped whenever a spatial unit in the project is saved or closed, so
+# stale tiles just age out of the cache.
+
+TILE_SIZE = 256
+TILE_TIMEOUT = 24 * 60 * 60
+
+
+def spatial_index_sql():
+    """
+    SQL for a partial GiST index over the geometries of current
+    spatial unit versions, for use in a ``RunSQL`` migration.
+    """
+    table = SpatialUnit._meta.db_table
+    return ('CREATE INDEX "{0}_current_geometry" ON "{0}" '
+            'USING gist ("geometry") '
+            'WHERE "{1}" IS NULL AND "{2}" IS NULL'.format(
+                table, EFFECTIVE_TO, ASSERT_TO))
+
+
+def tile_bbox(zoom, x, y):
+    """
+    Longitude/latitude bounding box of a web map (slippy map) tile.
+    """
+    n = 2 ** zoom
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return (x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+
+def tolerance(zoom):
+    """
+    Simplification tolerance (in degrees) for a zoom level: about one
+    pixel, so simplification isn't visible.
+    """
+    return 360.0 / (TILE_SIZE * 2 ** zoom)
+
+
+VIEWPORT_SQL = """
+SELECT id, type, geojson FROM (
+    SELECT id, type,
+           ST_SimplifyPreserveTopology(ST_ClipByBox2D(geometry, box), %s)
+               AS simplified
+    FROM {table}, ST_MakeEnvelope(%s, %s, %s, %s, 4326) AS box
+    WHERE project_id = %s AND {current} {type}
+      AND ST_Intersects(geometry, box)
+      AND (ST_Dimension(geometry) = 0 OR
+           greatest(ST_XMax(geometry) - ST_XMin(geometry),
+                    ST_YMax(geometry) - ST_YMin(geometry)) >= %s)
+) AS clipped, ST_AsGeoJSON(simplified) AS geojson
+WHERE NOT ST_IsEmpty(simplified)
+"""
+
+
+def viewport(project, bbox, zoom, type=None):
+    """
+    Current spatial units of a project whose geometries intersect a
+    (min lon, min lat, max lon, max lat) bounding box, as a GeoJSON
+    feature collection.  The database clips the geometries to the box,
+    simplifies them for the zoom level and drops features smaller than
+    a pixel, so only what will be drawn comes over the wire.
+    """
+    tol = tolerance(zoom)
+    sql = VIEWPORT_SQL.format(
+        table=connection.ops.quote_name(SpatialUnit._meta.db_table),
+        current='"{}" IS NULL AND "{}" IS NULL'.format(EFFECTIVE_TO,
+                                                       ASSERT_TO),
+        type='AND type = %s' if type is not None else ''
+    )
+    params = [tol] + list(bbox) + [getattr(project, 'pk', project)]
+    if type is not None:
+        params.append(type)
+    params.append(tol)
+    features = []
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for su_id, su_type, geojson in cursor:
+            features.append({
+                'type': 'Feature',
+                'id': su_id,
+                'properties': {'type': su_type},
+                'geometry': json.loads(geojson),
+            })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def tile(project, zoom, x, y, type=None):
+    """
+    Cached ``viewport`` for a single map tile.
+    """
+    project_id = getattr(project, 'pk', project)
+    key = 'spatial-tile:{}:{}:{}:{}:{}:{}'.format(
+        project_id, type or '', _tile_version(project_id), zoom, x, y)
+    result = cache.get(key)
+    if result is None:
+        result = viewport(project_id, tile_bbox(zoom, x, y), zoom, type)
+        cache.set(key, result, TILE_TIMEOUT)
+    return result
+
+
+def _version_key(project_id):
+    return 'spatial-tile-version:{}'.format(project_id)
+
+
+def _tile_version(project_id):
+    return cache.get_or_set(_version_key(project_id), 0, None)
+
+
+def invalidate_tiles(project_id):
+    """
+    Move a project's tile version on once the current transaction
+    commits: a tile rendered before the commit would otherwise be
+    cached under the new version with the old geometries.
+    """
+    key = _version_key(project_id)
+
+    def bump():
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+    transaction.on_commit(bump)
+
+
+@receiver(post_save, sender=SpatialUnit)
+@receiver(post_delete, sender=SpatialUnit)
+def _spatial_unit_changed(sender, instance, **kwargs):
+    invalidate_tiles(instance.project_id)
+
+
+@receiver(versions_saved, sender=SpatialUnit)
+def _spatial_units_saved(sender, instances, **kwargs):
+    for project_id in set(su.project_id for su in instances):
+        invalidate_tiles(project_id)
+
+
+@receiver(versions_closed, sender=SpatialUnit)
+def _spatial_units_closed(sender, ids, **kwargs):
+    project_ids = (SpatialUnit.objects.filter(id__in=ids)
+                   .values_list('project_id', flat=True).distinct())
+    for project_id in project_ids:
+        invalidate_tiles(project_id)
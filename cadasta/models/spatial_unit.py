@@ -5,7 +5,9 @@ from django.contrib.gis.db.models import GeometryField
 from bitemporal import bitemporal, TemporalForeignKey, TemporalManyToManyField
 
 from .project import Project
+from .temporal import BitemporalManager
 from .attributes import JSONAttributesField
+from .resource import ResourceAccessor
 
 
 @bitemporal
@@ -43,12 +45,16 @@ class SpatialUnit(RandomIDModel):
                     (NATIONAL_PARK_BOUNDARY, 'National park boundary'),
                     (MISCELLANEOUS,          'Miscellaneous'))
 
+    objects = BitemporalManager()
+
     # All spatial units are associated with a single project.
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
 
     # Spatial unit geometry is optional: some spatial units may only
-    # have a textual description of their location.
-    geometry = GeometryField(null=True)
+    # have a textual description of their location.  Map queries only
+    # look at current versions, and use the partial index from
+    # spatial_tiles.spatial_index_sql; this one covers history.
+    geometry = GeometryField(null=True, spatial_index=True)
 
     # Spatial unit type: used to manage range of allowed attributes.
     type = models.CharField(max_length=2,
@@ -57,6 +63,9 @@ class SpatialUnit(RandomIDModel):
     # JSON attributes field with management of allowed members.
     attributes = JSONAttributesField()
 
+    # Resources attached to this object (see ResourceAccessor).
+    resources = ResourceAccessor()
+
     # Spatial unit-spatial unit relationships: includes spatial
     # containment and split/merge relationships.
     relationships = TemporalManyToManyField(
@@ -80,6 +89,8 @@ class SpatialUnitRelationship(RandomIDModel):
                     ('S', 'is-split-of'),
                     ('M', 'is-merge-of'))
 
+    objects = BitemporalManager()
+
     # All spatial unit relationships are associated with a single
     # project.
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
@@ -94,3 +105,6 @@ class SpatialUnitRelationship(RandomIDModel):
 
     # JSON attributes field with management of allowed members.
     attributes = JSONAttributesField()
+
+    # Resources attached to this object (see ResourceAccessor).
+    resources = ResourceAccessor()
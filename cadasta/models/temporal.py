@@ -0,0 +1,474 @@
+import hashlib
+
+from django.db import connections, IntegrityError, models, transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from cadasta.core.models import ID_FIELD_LENGTH
+
+from . import instrumentation
+
+
+# Names of the time columns added by the ``bitemporal`` decorator.
+# Each version of an entity is valid over the effective time range
+# [effective_from, effective_to) and was asserted (i.e. believed by
+# the database) over [assert_from, assert_to).  Open-ended ranges are
+# stored as NULL, so the current version of an entity is the one with
+# both effective_to and assert_to NULL.  The composite primary key is
+# (id, effective_from, assert_from).
+EFFECTIVE_FROM = 'effective_from'
+EFFECTIVE_TO = 'effective_to'
+ASSERT_FROM = 'assert_from'
+ASSERT_TO = 'assert_to'
+
+CURRENT = {EFFECTIVE_TO + '__isnull': True, ASSERT_TO + '__isnull': True}
+
+
+# Sent by the bulk write path, which doesn't go through the per-object
+# ``save`` and ``delete`` methods and so doesn't send Django's
+# ``post_save`` and ``post_delete`` signals.  ``instances`` are the new
+# versions written, ``ids`` are the entity IDs whose current versions
+# were closed, ``timestamp`` is the assert time used for the batch and
+# ``effective`` is the effective time of the change.
+versions_saved = Signal(providing_args=['instances', 'timestamp', 'effective'])
+versions_closed = Signal(providing_args=['ids', 'timestamp', 'effective'])
+
+
+class VersionConflict(Exception):
+    """
+    Raised by ``save_versions`` when some of the versions being
+    replaced are no longer current, i.e. another writer got there
+    first.  ``ids`` are the conflicting entity IDs.
+    """
+    def __init__(self, model, ids):
+        self.model = model
+        self.ids = list(ids)
+        super(VersionConflict, self).__init__(
+            '{}: {} version conflict(s): {}'.format(
+                model._meta.label, len(self.ids),
+                ', '.join(str(i) for i in self.ids[:10]))
+        )
+
+
+PERIOD_FIELDS = (EFFECTIVE_FROM, EFFECTIVE_TO, ASSERT_FROM, ASSERT_TO)
+
+
+def _period(obj):
+    return [getattr(obj, name, None) for name in PERIOD_FIELDS]
+
+
+def _set_period(obj, period):
+    for name, value in zip(PERIOD_FIELDS, period):
+        setattr(obj, name, value)
+
+
+def _violates_current(model, exc):
+    """
+    Whether an ``IntegrityError`` is a violation of a model's unique
+    current version index (see ``temporal_index_sql``).
+    """
+    diag = getattr(exc.__cause__, 'diag', None)
+    return (isinstance(exc, IntegrityError) and
+            getattr(diag, 'constraint_name', None) ==
+            model._meta.db_table + '_current')
+
+
+class BitemporalQuerySet(models.QuerySet):
+    """
+    Query set for ``@bitemporal`` models, adding as-of reads,
+    batched resolution of temporal foreign keys and set-based bulk
+    temporal writes.  Every version written by a single bulk call
+    shares the same assert time.
+
+    """
+    _as_of = None
+    _temporal_lookups = ()
+
+    def current(self):
+        """
+        Restrict to current versions: the fast path for "now" reads,
+        which only touches open-ended rows and so can be answered from
+        the partial current-version index (see ``temporal_index_sql``).
+        """
+        clone = self.filter(**CURRENT)
+        clone._as_of = (None, None)
+        return clone
+
+    def as_of(self, effective=None, asserted=None):
+        """
+        Restrict to the versions that were effective at ``effective``
+        according to what the database believed at ``asserted``.  Both
+        default to now; if neither is given, this is just ``current``.
+        The conditions are written as range containment tests so that
+        they can use the GiST indexes from ``temporal_index_sql``.
+        """
+        if effective is None and asserted is None:
+            return self.current()
+        now = timezone.now()
+        effective = effective or now
+        asserted = asserted or now
+        table = self.model._meta.db_table
+        where = [_range_sql(table, EFFECTIVE_FROM, EFFECTIVE_TO) + ' @> %s',
+                 _range_sql(table, ASSERT_FROM, ASSERT_TO) + ' @> %s']
+        clone = self.extra(where=where, params=[effective, asserted])
+        clone._as_of = (effective, asserted)
+        return clone
+
+    def prefetch_temporal(self, *lookups):
+        """
+        The temporal equivalent of ``prefetch_related`` for
+        ``TemporalForeignKey`` fields: after the query set is
+        evaluated, each lookup (e.g. ``'party'``, ``'spatial_unit'`` or
+        ``'group__parent'``) is resolved with one query per relation,
+        fetching the target versions valid at the same time as this
+        query set (see ``as_of``) and caching them on the instances.
+        The query set must be time-qualified with ``current()`` or
+        ``as_of()`` before it's evaluated: otherwise its rows can be
+        versions from any time, and there's no single time to resolve
+        the targets at, so ``ValueError`` is raised.
+        """
+        clone = self._clone()
+        clone._temporal_lookups = self._temporal_lookups + lookups
+        return clone
+
+    def _clone(self, **kwargs):
+        clone = super(BitemporalQuerySet, self)._clone(**kwargs)
+        clone._as_of = self._as_of
+        clone._temporal_lookups = self._temporal_lookups
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        if not fetched and self._temporal_lookups and self._as_of is None:
+            raise ValueError('prefetch_temporal() needs a query set '
+                             'restricted with current() or as_of()')
+        super(BitemporalQuerySet, self)._fetch_all()
+        if not fetched and self._temporal_lookups:
+            prefetch_temporal(self._result_cache, self._temporal_lookups,
+                              self._as_of, using=self.db)
+
+    def bulk_save(self, objs, effective=None, batch_size=1000):
+        """
+        Write new versions of many entities at once.  Any existing
+        current versions of the entities are closed as of ``effective``
+        (default: now) exactly as ``bulk_close`` does, then the new
+        versions are inserted with effective time starting at
+        ``effective``.  Objects whose ID doesn't match an existing
+        entity are new entities; for models with random (non-auto) IDs
+        they need their IDs set beforehand (see ``derived_id``).
+        Returns the list of objects written.
+        """
+        return self._save(objs, effective, batch_size, checked=False)
+
+    def save_versions(self, objs, effective=None, batch_size=1000):
+        """
+        Like ``bulk_save``, but with optimistic concurrency control.
+        Each object's ``assert_from``, as it was read, is its version
+        token: the write only goes ahead if every object is still the
+        current version it was read as (or, for objects that were never
+        saved, if there is still no current version with its ID).
+        Otherwise nothing is written and ``VersionConflict`` is raised.
+        No locks are taken beyond the row locks of the closing UPDATE,
+        so writers working on different entities never wait for each
+        other.  On success the objects carry their new tokens.  See
+        ``optimistic_update`` for retrying on conflict.
+        """
+        return self._save(objs, effective, batch_size, checked=True)
+
+    def _save(self, objs, effective, batch_size, checked):
+        objs = list(objs)
+        now = timezone.now()
+        effective = effective or now
+        ids = [obj.id for obj in objs if obj.id is not None]
+        tokens = None
+        if checked:
+            tokens = dict((obj.id, getattr(obj, ASSERT_FROM, None))
+                          for obj in objs if obj.id is not None)
+        with instrumentation.operation('temporal.insert', self.model,
+                                       self.db) as op:
+            op.rows = len(objs)
+            with transaction.atomic(using=self.db):
+                self._close(ids, effective, now, tokens)
+                previous = [_period(obj) for obj in objs]
+                for obj in objs:
+                    setattr(obj, EFFECTIVE_FROM, effective)
+                    setattr(obj, EFFECTIVE_TO, None)
+                    setattr(obj, ASSERT_FROM, now)
+                    setattr(obj, ASSERT_TO, None)
+                try:
+                    self.bulk_create(objs, batch_size=batch_size)
+                except Exception as exc:
+                    # Nothing was written, so the objects keep their
+                    # old versions (and tokens).
+                    for obj, period in zip(objs, previous):
+                        _set_period(obj, period)
+                    # A concurrent writer created one of the new
+                    # entities first (caught by the unique current
+                    # version index).
+                    if checked and _violates_current(self.model, exc):
+                        raise VersionConflict(self.model, [
+                            i for i, token in tokens.items() if token is None
+                        ])
+                    raise
+        versions_saved.send(sender=self.model, instances=objs, timestamp=now,
+                            effective=effective)
+        return objs
+
+    def bulk_close(self, ids, effective=None):
+        """
+        End the effective time of the current versions of many
+        entities as of ``effective`` (default: now): the temporal
+        equivalent of a bulk delete.  Returns the number of versions
+        closed.
+        """
+        ids = list(ids)
+        now = timezone.now()
+        effective = effective or now
+        with instrumentation.operation('temporal.close', self.model,
+                                       self.db) as op:
+            with transaction.atomic(using=self.db):
+                closed = op.rows = self._close(ids, effective, now)
+        versions_closed.send(sender=self.model, ids=ids, timestamp=now,
+                             effective=effective)
+        return closed
+
+    def _close(self, ids, effective, now, tokens=None):
+        """
+        Close the current versions of the given entities using two
+        statements: an UPDATE that ends the assertion of the current
+        versions, then an INSERT ... SELECT that re-asserts the part of
+        each closed version's effective range before ``effective``.
+
+        With ``tokens`` (a dict mapping IDs to the ``assert_from`` of
+        the version expected to be current, or None if no current
+        version is expected), the UPDATE only matches the expected
+        versions, and ``VersionConflict`` is raised unless it matched
+        all of them.  Under concurrent writes, the UPDATE waits for
+        any other transaction closing the same rows and then rechecks
+        them, so exactly one writer wins.
+        """
+        if not ids:
+            return 0
+        closing = (self.model._base_manager.using(self.db)
+                   .filter(id__in=ids, **CURRENT))
+        if tokens is not None:
+            closing = self._check_tokens(closing, tokens)
+        closed = closing.update(**{ASSERT_TO: now})
+        if tokens is not None:
+            self._check_closed(tokens, closed, now)
+        if not closed:
+            return 0
+
+        meta = self.model._meta
+        qn = connections[self.db].ops.quote_name
+        overrides = {EFFECTIVE_TO: effective, ASSERT_FROM: now}
+        columns = [f.column for f in meta.concrete_fields]
+        select, params = [], []
+        for column in columns:
+            if column in overrides:
+                select.append('%s')
+                params.append(overrides[column])
+            elif column == ASSERT_TO:
+                select.append('NULL')
+            else:
+                select.append(qn(column))
+        sql = ('INSERT INTO {table} ({columns}) '
+               'SELECT {select} FROM ONLY {table} '
+               'WHERE {id} = ANY(%s) AND {assert_to} = %s '
+               'AND {effective_to} IS NULL AND {effective_from} < %s').format(
+            table=qn(meta.db_table),
+            columns=', '.join(qn(c) for c in columns),
+            select=', '.join(select),
+            id=qn(meta.get_field('id').column),
+            assert_to=qn(ASSERT_TO),
+            effective_to=qn(EFFECTIVE_TO),
+            effective_from=qn(EFFECTIVE_FROM),
+        )
+        params += [list(ids), now, effective]
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+        return closed
+
+    def _check_tokens(self, queryset, tokens):
+        expected = [(i, token) for i, token in tokens.items()
+                    if token is not None]
+        created = [i for i, token in tokens.items() if token is None]
+        if created and queryset.filter(id__in=created).exists():
+            raise VersionConflict(self.model, queryset.filter(
+                id__in=created).values_list('id', flat=True))
+        if not expected:
+            return queryset.none()
+        where = ('("{0}"."id", "{0}"."{1}") IN '
+                 '(SELECT * FROM unnest(%s, %s))').format(
+            self.model._meta.db_table, ASSERT_FROM)
+        return queryset.extra(
+            where=[where],
+            params=[[i for i, _ in expected], [t for _, t in expected]]
+        )
+
+    def _check_closed(self, tokens, closed, now):
+        expected = [i for i, token in tokens.items() if token is not None]
+        if closed == len(expected):
+            return
+        done = set(self.model._base_manager.using(self.db)
+                   .filter(id__in=expected, **{EFFECTIVE_TO + '__isnull': True,
+                                               ASSERT_TO: now})
+                   .values_list('id', flat=True))
+        raise VersionConflict(self.model,
+                              [i for i in expected if i not in done])
+
+
+BitemporalManager = models.Manager.from_queryset(BitemporalQuerySet)
+
+
+def optimistic_update(model, ids, change, merge=None, retries=3,
+                      effective=None):
+    """
+    Apply ``change`` (a function that modifies a model instance in
+    place) to the current versions of some entities and write them
+    with ``save_versions``, retrying on conflict.  On a conflict, the
+    latest versions of the conflicting entities are read and
+    ``merge(mine, latest)`` is called for each to get the object to
+    write instead (it must carry ``latest``'s version token); by
+    default, ``change`` is simply applied again to the latest version.
+    Gives up (re-raising ``VersionConflict``) after ``retries``
+    retries, or if a conflicting entity has been closed.  Returns the
+    objects written.
+    """
+    def reapply(mine, latest):
+        change(latest)
+        return latest
+
+    merge = merge or reapply
+    objs = list(model.objects.current().filter(id__in=ids))
+    for obj in objs:
+        change(obj)
+    attempt = 0
+    while True:
+        try:
+            return model.objects.save_versions(objs, effective)
+        except VersionConflict as conflict:
+            if attempt >= retries:
+                raise
+            attempt += 1
+            latest = dict((obj.id, obj) for obj in
+                          model.objects.current().filter(id__in=conflict.ids))
+            if len(latest) < len(set(conflict.ids)):
+                raise
+            objs = [merge(obj, latest[obj.id]) if obj.id in latest else obj
+                    for obj in objs]
+
+
+def derived_id(*parts):
+    """
+    A deterministic entity ID derived from the given parts, for bulk
+    loads: rows derived from the same source data always get the same
+    ID, so re-running a load writes new versions of the same entities
+    instead of duplicating them.
+    """
+    key = '\x1f'.join(str(part) for part in parts).encode('utf-8')
+    return hashlib.sha1(key).hexdigest()[:ID_FIELD_LENGTH]
+
+
+def closed_versions(model, ids, timestamp):
+    """
+    The versions of the given entities that were current until being
+    closed at assert time ``timestamp``, as a dict keyed on entity ID.
+    Used by write hooks that need to know what a new version replaced
+    (pass the new version's ``assert_from``) or what was deleted.
+    """
+    queryset = model._base_manager.filter(
+        id__in=ids, **{EFFECTIVE_TO + '__isnull': True, ASSERT_TO: timestamp}
+    )
+    return dict((obj.id, obj) for obj in queryset)
+
+
+def prefetch_temporal(instances, lookups, as_of=None, using=None):
+    """
+    Resolve temporal foreign key lookups for a list of model instances
+    with one query per relation, rather than one per instance.  Target
+    versions are those valid at ``as_of`` (an ``(effective, asserted)``
+    pair, or None for current versions).  Lookups sharing a prefix
+    share queries.
+    """
+    effective, asserted = as_of or (None, None)
+    resolved = {}
+    for lookup in lookups:
+        objs = [obj for obj in instances if isinstance(obj, models.Model)]
+        path = ()
+        for name in lookup.split('__'):
+            path += (name,)
+            if path not in resolved:
+                resolved[path] = _prefetch_field(objs, name, effective,
+                                                 asserted, using)
+            objs = resolved[path]
+
+
+def _prefetch_field(objs, name, effective, asserted, using):
+    """
+    Fetch and cache the targets of a single foreign key field for a
+    list of instances of one model, returning the distinct targets.
+    """
+    if not objs:
+        return []
+    # Reverse accessors (e.g. ``Party.resources``) can take part by
+    # providing a ``prefetch`` method.
+    descriptor = getattr(type(objs[0]), name, None)
+    with instrumentation.operation('temporal_fk.prefetch', type(objs[0]),
+                                   using, field=name) as op:
+        op.rows = len(objs)
+        if hasattr(descriptor, 'prefetch'):
+            return descriptor.prefetch(objs, effective, asserted, using)
+        return _prefetch_foreign_key(objs, name, effective, asserted, using)
+
+
+def _prefetch_foreign_key(objs, name, effective, asserted, using):
+    field = objs[0]._meta.get_field(name)
+    target = field.related_model
+    ids = set(getattr(obj, field.attname) for obj in objs)
+    ids.discard(None)
+    queryset = BitemporalQuerySet(model=target, using=using)
+    if any(f.name == EFFECTIVE_FROM for f in target._meta.concrete_fields):
+        queryset = queryset.as_of(effective, asserted)
+    targets = dict((t.id, t) for t in queryset.filter(id__in=ids))
+    cache_name = field.get_cache_name()
+    for obj in objs:
+        setattr(obj, cache_name, targets.get(getattr(obj, field.attname)))
+    return list(targets.values())
+
+
+def _range_sql(table, lower, upper):
+    return 'tstzrange("{0}"."{1}", "{0}"."{2}")'.format(table, lower, upper)
+
+
+def temporal_index_sql(model):
+    """
+    SQL to create the temporal indexes for a bitemporal model, for use
+    in a ``RunSQL`` migration operation.  There are two indexes:
+
+     * a partial unique B-tree index covering only current versions,
+       keyed on (project, id) if the model has a project, used by
+       ``current()`` and so unaffected by the amount of history, and
+       also guaranteeing a single current version per entity (which
+       ``save_versions`` relies on to detect concurrent creation);
+
+     * a GiST index over the effective and assert time ranges (plus
+       project, using btree_gist), used by ``as_of()`` for historical
+       reads.
+
+    """
+    table = model._meta.db_table
+    fields = [f.name for f in model._meta.concrete_fields]
+    keys = ['"id"']
+    if 'project' in fields:
+        keys.insert(0, '"project_id"')
+    ranges = ['tstzrange("{0}", "{1}")'.format(EFFECTIVE_FROM, EFFECTIVE_TO),
+              'tstzrange("{0}", "{1}")'.format(ASSERT_FROM, ASSERT_TO)]
+    return [
+        'CREATE EXTENSION IF NOT EXISTS btree_gist',
+        'CREATE UNIQUE INDEX "{0}_current" ON "{0}" ({1}) '
+        'WHERE "{2}" IS NULL AND "{3}" IS NULL'.format(
+            table, ', '.join(keys), EFFECTIVE_TO, ASSERT_TO),
+        'CREATE INDEX "{0}_as_of" ON "{0}" USING gist ({1})'.format(
+            table, ', '.join(keys[:-1] + ranges)),
+    ]
@@ -0,0 +1,188 @@
+from django.contrib.gis.db.models import PointField, PolygonField
+from django.contrib.gis.geos import Polygon
+from django.contrib.postgres.fields import JSONField
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+
+from cadasta.core.models import ID_FIELD_LENGTH
+
+from .project import Project
+from .party import Party
+from .spatial_unit import SpatialUnit
+from .tenure_relationship import TenureRelationship, TenureRelationshipType
+from .temporal import versions_saved, versions_closed
+
+
+# Denormalised read model for the "who holds what rights on which
+# parcel" listing.  Listing tenure relationships properly means
+# joining TenureRelationship to Party, SpatialUnit and
+# TenureRelationshipType, all restricted to current versions, and
+# digging into the attributes JSON.  This keeps one flat row per
+# current tenure relationship with everything the listing shows, so
+# listing, filtering and paging are single-table indexed queries.
+#
+# The table is optional: it's only maintained if this module is
+# loaded.  Rows are refreshed from the bitemporal write hooks for all
+# four source models, and ``rebuild`` repopulates a project's rows
+# from scratch (e.g. after enabling it, or to repair drift).
+
+# Attributes copied into the listing row's ``attributes`` column, per
+# source: a tuple of names, or None for all of them.  Keys in the row
+# are "<source>.<name>", e.g. "party.gender".
+LISTED_ATTRIBUTES = {'tenure': None, 'party': (), 'spatial_unit': ()}
+
+
+class TenureListing(models.Model):
+    # Same ID as the tenure relationship.
+    id = models.CharField(primary_key=True, max_length=ID_FIELD_LENGTH)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+
+    party_id = models.CharField(max_length=ID_FIELD_LENGTH, db_index=True)
+    party_name = models.CharField(max_length=200)
+    party_type = models.CharField(max_length=2)
+
+    spatial_unit_id = models.CharField(max_length=ID_FIELD_LENGTH,
+                                       db_index=True)
+    spatial_unit_type = models.CharField(max_length=2)
+    centroid = PointField(null=True)
+    bbox = PolygonField(null=True, spatial_index=False)
+
+    tenure_type_id = models.IntegerField(db_index=True)
+    tenure_type = models.CharField(max_length=100)
+    tenure_category = models.CharField(
+        max_length=5, choices=TenureRelationshipType.TYPE_CHOICES
+    )
+
+    attributes = JSONField(default=dict)
+
+    class Meta:
+        index_together = [['project', 'party_name', 'id'],
+                          ['project', 'spatial_unit_type', 'id'],
+                          ['project', 'tenure_category', 'tenure_type', 'id']]
+
+
+def _attributes(source, obj):
+    names = LISTED_ATTRIBUTES.get(source, ())
+    values = obj.attributes or {}
+    if names is not None:
+        values = dict((name, values[name]) for name in names
+                      if name in values)
+    return dict(('{}.{}'.format(source, name), value)
+                for name, value in values.items())
+
+
+def listing_row(rel):
+    """
+    The listing row for a current tenure relationship version whose
+    party, spatial unit and type have been resolved, or None if any of
+    them no longer has a current version.
+    """
+    party, su, tenure_type = rel.party, rel.spatial_unit, rel.type
+    if party is None or su is None or tenure_type is None:
+        return None
+    attributes = _attributes('tenure', rel)
+    attributes.update(_attributes('party', party))
+    attributes.update(_attributes('spatial_unit', su))
+    geometry = su.geometry
+    return TenureListing(
+        id=rel.id, project_id=rel.project_id,
+        party_id=party.id, party_name=party.name, party_type=party.type,
+        spatial_unit_id=su.id, spatial_unit_type=su.type,
+        centroid=geometry.centroid if geometry else None,
+        bbox=Polygon.from_bbox(geometry.extent) if geometry else None,
+        tenure_type_id=tenure_type.id, tenure_type=tenure_type.name,
+        tenure_category=tenure_type.type, attributes=attributes
+    )
+
+
+def refresh(ids, batch_size=1000):
+    """
+    Bring the listing rows for the given tenure relationship IDs up to
+    date: rows are rewritten from the current versions, and dropped
+    for relationships that are no longer current.
+    """
+    ids = list(set(ids))
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        rels = (TenureRelationship.objects.current().filter(id__in=batch)
+                .prefetch_temporal('party', 'spatial_unit', 'type'))
+        rows = [row for row in map(listing_row, rels) if row is not None]
+        with transaction.atomic():
+            TenureListing.objects.filter(id__in=batch).delete()
+            TenureListing.objects.bulk_create(rows)
+
+
+def _related(field, ids):
+    return (TenureRelationship.objects.current()
+            .filter(**{field + '__in': list(ids)})
+            .values_list('id', flat=True))
+
+
+def _affected(model, ids):
+    """
+    IDs of the tenure relationships whose listing rows depend on the
+    given entities.  These come from the current tenure relationships
+    rather than the listing itself, since an entity that was closed
+    (dropping its listing rows) may since have been saved again.
+    """
+    if model is TenureRelationship:
+        return ids
+    if model is Party:
+        return _related('party_id', ids)
+    if model is SpatialUnit:
+        return _related('spatial_unit_id', ids)
+    return _related('type_id', ids)
+
+
+LISTING_MODELS = (TenureRelationship, Party, SpatialUnit,
+                  TenureRelationshipType)
+
+
+def _changed(sender, instance, **kwargs):
+    refresh(_affected(sender, [instance.id]))
+
+
+def _bulk_saved(sender, instances, **kwargs):
+    refresh(_affected(sender, [obj.id for obj in instances]))
+
+
+def _bulk_closed(sender, ids, **kwargs):
+    refresh(_affected(sender, ids))
+
+
+for _model in LISTING_MODELS:
+    post_save.connect(_changed, sender=_model)
+    post_delete.connect(_changed, sender=_model)
+    versions_saved.connect(_bulk_saved, sender=_model)
+    versions_closed.connect(_bulk_closed, sender=_model)
+
+
+def rebuild(project, batch_size=1000):
+    """
+    Repopulate the listing rows for a project from the current
+    versions of its tenure relationships.  Returns the number of rows
+    written.
+    """
+    ids = list(TenureRelationship.objects.current().filter(project=project)
+               .values_list('id', flat=True))
+    with transaction.atomic():
+        TenureListing.objects.filter(project=project).delete()
+        refresh(ids, batch_size)
+    return TenureListing.objects.filter(project=project).count()
+
+
+def page(project, after=None, limit=50, order='party_name', **filters):
+    """
+    One page of a project's tenure listing, ordered on ``order`` (a
+    listing field) and ID, with keyset pagination: pass the last row
+    of one page as ``after`` to get the next.  ``filters`` are
+    ``TenureListing`` query filters, e.g. ``tenure_category='RIGHT'``.
+    """
+    queryset = TenureListing.objects.filter(project=project, **filters)
+    if after is not None:
+        value = getattr(after, order)
+        queryset = queryset.filter(
+            models.Q(**{order + '__gt': value}) |
+            models.Q(**{order: value, 'id__gt': after.id})
+        )
+    return list(queryset.order_by(order, 'id')[:limit])
@@ -6,9 +6,11 @@ from bitemporal import bitemporal, TemporalForeignKey
 from cadasta.core.models import RandomIDModel
 
 from .project import Project
+from .temporal import BitemporalManager
 from .party import Party
 from .spatial_unit import SpatialUnit
 from .attributes import JSONAttributesField
+from .resource import ResourceAccessor
 
 
 # Should tenure relationships also appear as a many-to-many field in
@@ -27,6 +29,8 @@ class TenureRelationshipType(Model):
                     ('RESTR', 'Restriction'),
                     ('RESPO', 'Responsibility'))
 
+    objects = BitemporalManager()
+
     # All tenure relationship types are associated with a single
     # project.
     project = TemporalForeignKey(Project, on_delete=bitemporal.CASCADE)
@@ -50,6 +54,8 @@ class TenureRelationship(RandomIDModel):
     unit: has a type and a set of attributes.
     """
 
+    objects = BitemporalManager()
+
     # All tenure relationships are associated with a single project.
     project = models.ForeignKey(Project)
 
@@ -63,3 +69,6 @@ class TenureRelationship(RandomIDModel):
 
     # JSON attributes field with management of allowed members.
     attributes = JSONAttributesField()
+
+    # Resources attached to this object (see ResourceAccessor).
+    resources = ResourceAccessor()
@@ -0,0 +1,203 @@
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .project import Project
+from .spatial_unit import SpatialUnit
+
+
+# Topology checks for spatial unit imports: overlapping parcels,
+# parcels outside the project extent and gaps inside community
+# boundaries.  Checking every pair of parcels is quadratic, so
+# candidate pairs come from an STR-tree spatial index, and the actual
+# geometry operations run over whole arrays of candidates at a time
+# using Shapely 2's vectorised functions.  Shapely (and numpy) are
+# only needed here, so they're imported on first use.
+#
+# Areas are compared as ratios rather than absolute values, so that
+# the checks work the same way whatever the projection.
+
+PARCEL_TYPES = (SpatialUnit.PARCEL,)
+
+# Parcels checked for overlaps per vectorised batch, which bounds the
+# memory used for candidate pairs and intersections.
+CHUNK_SIZE = 10000
+
+
+def _shapely():
+    try:
+        import numpy
+        import shapely
+    except ImportError:
+        raise ImproperlyConfigured('Topology checks require shapely >= 2')
+    return numpy, shapely
+
+
+class TopologyReport(object):
+    def __init__(self):
+        self.checked = 0
+        self.overlaps = []
+        self.outside_extent = []
+        self.gaps = []
+        self.invalid = []
+        # Current spatial units already in the project with invalid
+        # geometries.  They're left out of the checks, but aren't the
+        # batch's fault, so they don't affect ``ok``.
+        self.invalid_existing = []
+        self.seconds = 0.0
+
+    @property
+    def ok(self):
+        return not (self.overlaps or self.outside_extent or self.gaps or
+                    self.invalid)
+
+    def as_dict(self):
+        return {'checked': self.checked,
+                'overlaps': self.overlaps,
+                'outside_extent': self.outside_extent,
+                'gaps': self.gaps,
+                'invalid': self.invalid,
+                'invalid_existing': self.invalid_existing,
+                'seconds': self.seconds}
+
+
+def _from_wkb(numpy, shapely, geometries):
+    """
+    Shapely geometries from GEOS ones, going through WKB so the
+    conversion is vectorised.
+    """
+    wkb = numpy.array([bytes(g.wkb) for g in geometries], dtype=object)
+    return shapely.from_wkb(wkb)
+
+
+def _load(numpy, shapely, queryset, report):
+    """
+    IDs and Shapely geometries of existing spatial units.  Invalid
+    geometries would make the intersection and union operations fail,
+    so they're reported and left out.
+    """
+    rows = [(su_id, geometry)
+            for su_id, geometry in queryset.values_list('id', 'geometry')
+            if geometry is not None]
+    ids = [su_id for su_id, _ in rows]
+    geoms = _from_wkb(numpy, shapely, [g for _, g in rows])
+    valid = shapely.is_valid(geoms)
+    report.invalid_existing.extend(ids[i] for i in numpy.flatnonzero(~valid))
+    return [ids[i] for i in numpy.flatnonzero(valid)], geoms[valid]
+
+
+def check_import(project, spatial_units, overlap_ratio=0.01,
+                 gap_ratio=0.001):
+    """
+    Check a batch of spatial units being imported into a project
+    against each other and against the project's current spatial
+    units.  Parcels overlapping by more than ``overlap_ratio`` of the
+    smaller one's area, parcels not inside the project extent, and
+    gaps inside community boundaries bigger than ``gap_ratio`` of the
+    boundary's area are reported.  Existing spatial units with invalid
+    geometries are skipped and listed in ``invalid_existing``.
+    """
+    numpy, shapely = _shapely()
+    start = time.time()
+    report = TopologyReport()
+    project_id = getattr(project, 'pk', project)
+
+    batch = [su for su in spatial_units if su.geometry is not None]
+    batch_ids = [su.id for su in batch]
+    new = _from_wkb(numpy, shapely, [su.geometry for su in batch])
+    report.checked = len(batch)
+    valid = shapely.is_valid(new)
+    report.invalid = [batch_ids[i] for i in numpy.flatnonzero(~valid)]
+
+    existing = (SpatialUnit.objects.current()
+                .filter(project_id=project_id)
+                .exclude(id__in=batch_ids))
+    old_ids, old = _load(numpy, shapely,
+                         existing.filter(type__in=PARCEL_TYPES), report)
+
+    # All parcels, new ones first: pairs must involve a new parcel.
+    is_parcel = numpy.array([su.type in PARCEL_TYPES for su in batch],
+                            dtype=bool)
+    ids = batch_ids + old_ids
+    geoms = numpy.concatenate([new, old])
+    parcel = numpy.concatenate([is_parcel & valid,
+                                numpy.ones(len(old), dtype=bool)])
+    tree = shapely.STRtree(geoms)
+    _overlaps(numpy, shapely, tree, geoms, ids, parcel, len(batch),
+              overlap_ratio, report)
+    checked = numpy.flatnonzero(is_parcel & valid)
+    _outside_extent(shapely, project_id, new[checked],
+                    [batch_ids[i] for i in checked], report)
+
+    boundaries = [i for i, su in enumerate(batch)
+                  if su.type == SpatialUnit.COMMUNITY_BOUNDARY and valid[i]]
+    boundary_ids, boundary_geoms = _load(
+        numpy, shapely, existing.filter(type=SpatialUnit.COMMUNITY_BOUNDARY),
+        report
+    )
+    boundary_ids = [batch_ids[i] for i in boundaries] + boundary_ids
+    boundary_geoms = numpy.concatenate([new[boundaries], boundary_geoms])
+    _gaps(numpy, shapely, tree, geoms, parcel, boundary_ids, boundary_geoms,
+          gap_ratio, report)
+
+    report.seconds = time.time() - start
+    return report
+
+
+def _overlaps(numpy, shapely, tree, geoms, ids, parcel, nnew, ratio, report,
+              chunk_size=CHUNK_SIZE):
+    parcels = numpy.flatnonzero(parcel[:nnew])
+    for start in range(0, len(parcels), chunk_size):
+        query = parcels[start:start + chunk_size]
+        left, right = tree.query(geoms[query], predicate='intersects')
+        left = query[left]
+        # Keep each pair once, and only parcel-parcel pairs.
+        keep = parcel[right] & ((right >= nnew) | (left < right))
+        left, right = left[keep], right[keep]
+        if not len(left):
+            continue
+        overlap = shapely.area(shapely.intersection(geoms[left],
+                                                    geoms[right]))
+        smaller = numpy.minimum(shapely.area(geoms[left]),
+                                shapely.area(geoms[right]))
+        fraction = numpy.divide(overlap, smaller,
+                                out=numpy.zeros_like(overlap),
+                                where=smaller > 0)
+        for k in numpy.flatnonzero(fraction > ratio):
+            report.overlaps.append((ids[left[k]], ids[right[k]],
+                                    float(fraction[k])))
+
+
+def _outside_extent(shapely, project_id, parcels, parcel_ids, report):
+    extent_id = (Project.objects.filter(pk=project_id)
+                 .values_list('geometry_id', flat=True).first())
+    if extent_id is None or not len(parcels):
+        return
+    extent = (SpatialUnit.objects.current().filter(id=extent_id)
+              .values_list('geometry', flat=True).first())
+    if extent is None:
+        return
+    extent = shapely.from_wkb(bytes(extent.wkb))
+    if not shapely.is_valid(extent):
+        report.invalid_existing.append(extent_id)
+        return
+    shapely.prepare(extent)
+    inside = shapely.covered_by(parcels, extent)
+    report.outside_extent = [parcel_ids[i] for i, ok in enumerate(inside)
+                             if not ok]
+
+
+def _gaps(numpy, shapely, tree, geoms, parcel, boundary_ids, boundaries,
+          ratio, report):
+    if not len(boundaries):
+        return
+    bounds, members = tree.query(boundaries, predicate='intersects')
+    for b, boundary in enumerate(boundaries):
+        inside = members[(bounds == b) & parcel[members]]
+        covered = shapely.union_all(geoms[inside]) if len(inside) else None
+        gap = (boundary if covered is None
+               else shapely.difference(boundary, covered))
+        area = shapely.area(boundary)
+        fraction = shapely.area(gap) / area if area > 0 else 0.0
+        if fraction > ratio:
+            report.gaps.append((boundary_ids[b], float(fraction)))
@@ -0,0 +1,206 @@
+import math
+import re
+
+from django.core.exceptions import ValidationError
+
+
+# Normalisers for "full" attribute types.  Each normaliser takes a
+# value that has already passed the base type check and returns its
+# canonical form, raising ValueError if the value isn't valid for the
+# full type.  Attributes with a full type that doesn't appear here just
+# get the base type check.
+
+NORMALISERS = {}
+
+
+def normaliser(full_type):
+    def register(func):
+        NORMALISERS[full_type] = func
+        return func
+    return register
+
+
+def _digits(value):
+    return re.sub(r'\D', '', value)
+
+
+@normaliser('telephone-number')
+def normalise_telephone_number(value):
+    digits = _digits(value)
+    if not 7 <= len(digits) <= 15:
+        raise ValueError('not a telephone number')
+    return '+' + digits if value.strip().startswith('+') else digits
+
+
+@normaliser('us-telephone-number')
+def normalise_us_telephone_number(value):
+    digits = _digits(value)
+    if len(digits) == 11 and digits.startswith('1'):
+        digits = digits[1:]
+    if len(digits) != 10:
+        raise ValueError('not a US telephone number')
+    return '+1' + digits
+
+
+@normaliser('id-post-code')
+def normalise_id_post_code(value):
+    code = value.strip()
+    if not re.match(r'^\d{5}$', code):
+        raise ValueError('not an Indonesian post code')
+    return code
+
+
+@normaliser('gb-post-code')
+def normalise_gb_post_code(value):
+    code = re.sub(r'\s', '', value).upper()
+    if not re.match(r'^[A-Z]{1,2}\d[A-Z\d]?\d[A-Z]{2}$', code):
+        raise ValueError('not a UK post code')
+    return code[:-3] + ' ' + code[-3:]
+
+
+@normaliser('us-zip-code')
+def normalise_us_zip_code(value):
+    code = value.strip()
+    if not re.match(r'^\d{5}(-\d{4})?$', code):
+        raise ValueError('not a US ZIP code')
+    return code
+
+
+@normaliser('gb-driving-license-number')
+def normalise_gb_driving_license_number(value):
+    number = re.sub(r'\s', '', value).upper()
+    if not re.match(r'^[A-Z9]{5}\d{6}[A-Z9]{2}\d[A-Z]{2}$', number):
+        raise ValueError('not a UK driving license number')
+    return number
+
+
+# Base type checks.  Values coming from form data are often strings,
+# so the numeric checks accept anything that converts cleanly.
+# Integer strings are parsed with ``int``, never through ``float``, so
+# large values keep all their digits.
+
+def _finite(value, message):
+    try:
+        number = float(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(message)
+    if not math.isfinite(number):
+        raise ValueError(message)
+    return number
+
+
+def _check_number(value):
+    if isinstance(value, bool):
+        raise ValueError('expected a number')
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    number = _finite(value, 'expected a number')
+    if isinstance(value, float):
+        return value
+    return int(number) if number.is_integer() else number
+
+
+def _check_integer(value):
+    if isinstance(value, bool):
+        raise ValueError('expected an integer')
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        if not math.isfinite(value) or not value.is_integer():
+            raise ValueError('expected an integer')
+        return int(value)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError('expected an integer')
+
+
+def _check_fraction(value):
+    if isinstance(value, bool):
+        raise ValueError('expected a number')
+    return _finite(value, 'expected a number')
+
+
+def _check_text(value):
+    if not isinstance(value, str):
+        raise ValueError('expected text')
+    return value
+
+
+BASE_TYPE_CHECKS = {
+    'NO': _check_number,
+    'IN': _check_integer,
+    'FR': _check_fraction,
+    'TX': _check_text,
+}
+
+
+class AttributeValidator(object):
+    """
+    Validator compiled from a resolved attribute set.
+
+    All the per-attribute work (picking the base type check and full
+    type normaliser, working out which attributes are required) is done
+    once here, so validating a JSON attributes dict is a single pass
+    over its keys plus a set difference for missing required values.
+    Instances are immutable and safe to share between threads.
+
+    """
+    def __init__(self, attributes):
+        self.names = tuple(attr.name for attr in attributes)
+        self.required = frozenset(attr.name for attr in attributes
+                                  if attr.presence == 'R')
+        self._checks = {}
+        for attr in attributes:
+            base = BASE_TYPE_CHECKS.get(attr.base_type, _check_text)
+            full = NORMALISERS.get(attr.full_type)
+            self._checks[attr.name] = (base, full)
+
+    def check(self, data):
+        """
+        Validate and normalise a JSON attributes dict.  Returns a pair
+        ``(normalised, errors)``, where ``errors`` maps attribute names
+        to error messages and is empty if the dict is valid.
+        """
+        if not isinstance(data, dict):
+            return None, {'__all__': 'attributes must be a JSON object'}
+
+        normalised = {}
+        errors = {}
+        for name, value in data.items():
+            try:
+                base, full = self._checks[name]
+            except KeyError:
+                errors[name] = 'unknown attribute'
+                continue
+            if value is None:
+                if name in self.required:
+                    errors[name] = 'value required'
+                continue
+            try:
+                value = base(value)
+                if full is not None:
+                    value = full(str(value))
+            except (TypeError, ValueError) as exc:
+                errors[name] = str(exc) or 'invalid value'
+            else:
+                normalised[name] = value
+
+        for name in self.required.difference(data):
+            errors[name] = 'value required'
+        return normalised, errors
+
+    def validate(self, data):
+        """
+        Like ``check``, but returns the normalised dict and raises a
+        ``ValidationError`` if there are any errors.
+        """
+        normalised, errors = self.check(data)
+        if errors:
+            raise ValidationError(errors)
+        return normalised
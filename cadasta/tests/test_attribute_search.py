@@ -0,0 +1,34 @@
+from collections import namedtuple
+
+from django.test import SimpleTestCase
+
+from cadasta.models.attribute_search import search_key, TEXT_KEY_LENGTH
+
+
+Attr = namedtuple('Attr', 'base_type full_type')
+
+
+class SearchKeyTest(SimpleTestCase):
+    def test_numeric_attributes_get_number_keys(self):
+        self.assertEqual(search_key(Attr('IN', ''), '42'), (None, 42.0))
+        self.assertEqual(search_key(Attr('NO', ''), 2.5), (None, 2.5))
+        self.assertEqual(search_key(Attr('FR', ''), '0.5'), (None, 0.5))
+
+    def test_text_keys_are_folded(self):
+        self.assertEqual(search_key(Attr('TX', ''), '  Hello\tWORLD '),
+                         ('hello world', None))
+        key, _ = search_key(Attr('TX', ''), 'x' * (TEXT_KEY_LENGTH + 10))
+        self.assertEqual(len(key), TEXT_KEY_LENGTH)
+
+    def test_full_types_are_normalised(self):
+        attr = Attr('TX', 'us-telephone-number')
+        self.assertEqual(search_key(attr, '(555) 123-4567'),
+                         search_key(attr, '555.123.4567'))
+        self.assertEqual(search_key(attr, '555.123.4567'),
+                         ('+15551234567', None))
+
+    def test_invalid_values_have_no_key(self):
+        self.assertIsNone(search_key(Attr('IN', ''), 'many'))
+        self.assertIsNone(search_key(Attr('TX', ''), 12))
+        self.assertIsNone(search_key(Attr('TX', 'us-telephone-number'),
+                                     '123'))
@@ -0,0 +1,23 @@
+from datetime import datetime, timezone
+
+from django.test import SimpleTestCase
+
+from cadasta.models.change_feed import decode_cursor, encode_cursor
+
+
+class CursorTest(SimpleTestCase):
+    def test_round_trip(self):
+        position = (datetime(2016, 5, 4, 3, 2, 1, 123456, tzinfo=timezone.utc),
+                    'cadasta.party', 'abc123')
+        cursor = encode_cursor(position)
+        self.assertIsInstance(cursor, str)
+        self.assertEqual(decode_cursor(cursor), position)
+
+    def test_cursor_is_url_safe(self):
+        cursor = encode_cursor((datetime.now(timezone.utc),
+                                'cadasta.spatialunit', '?/+' * 10))
+        self.assertRegex(cursor, r'^[A-Za-z0-9_=-]+$')
+
+    def test_empty_cursor(self):
+        self.assertIsNone(decode_cursor(None))
+        self.assertIsNone(decode_cursor(''))
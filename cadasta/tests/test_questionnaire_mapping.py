@@ -0,0 +1,29 @@
+from django.test import SimpleTestCase
+
+from cadasta.models.questionnaire_mapping import odk_geometry
+
+
+class ODKGeometryTest(SimpleTestCase):
+    def test_geopoint(self):
+        self.assertEqual(odk_geometry('-1.5 36.8 1700 5'),
+                         'POINT(36.8 -1.5)')
+
+    def test_geotrace(self):
+        self.assertEqual(odk_geometry('1 2 0 0;3 4 0 0'),
+                         'LINESTRING(2.0 1.0, 4.0 3.0)')
+        # A closed geotrace is still a line if the question says so.
+        self.assertEqual(odk_geometry('1 2;3 4;5 6;1 2', 'LINESTRING'),
+                         'LINESTRING(2.0 1.0, 4.0 3.0, 6.0 5.0, 2.0 1.0)')
+
+    def test_geoshape(self):
+        polygon = 'POLYGON((2.0 1.0, 4.0 3.0, 6.0 5.0, 2.0 1.0))'
+        self.assertEqual(odk_geometry('1 2;3 4;5 6;1 2'), polygon)
+        # Unclosed rings are closed.
+        self.assertEqual(odk_geometry('1 2;3 4;5 6;', 'POLYGON'), polygon)
+
+    def test_malformed(self):
+        for value, kind in (('', None), ('1', None), ('a b', None),
+                            ('1 2;3', None), ('1 2;3 4', 'POINT'),
+                            ('1 2', 'LINESTRING'), ('1 2;3 4', 'POLYGON')):
+            with self.assertRaises(ValueError):
+                odk_geometry(value, kind)
@@ -0,0 +1,15 @@
+from django.test import SimpleTestCase
+
+from cadasta.core.models import ID_FIELD_LENGTH
+from cadasta.models.temporal import derived_id
+
+
+class DerivedIDTest(SimpleTestCase):
+    def test_deterministic(self):
+        self.assertEqual(derived_id('party', 1, 'abc'),
+                         derived_id('party', '1', 'abc'))
+        self.assertEqual(len(derived_id('party', 1)), ID_FIELD_LENGTH)
+
+    def test_parts_are_separated(self):
+        self.assertNotEqual(derived_id('ab', 'c'), derived_id('a', 'bc'))
+        self.assertNotEqual(derived_id('party', 1), derived_id('party', 2))
@@ -0,0 +1,115 @@
+from collections import namedtuple
+
+from django.core.exceptions import ValidationError
+from django.test import SimpleTestCase
+
+from cadasta.models.validation import (AttributeValidator, BASE_TYPE_CHECKS,
+                                       NORMALISERS)
+
+
+Attr = namedtuple('Attr', 'name base_type full_type presence')
+
+
+class BaseTypeCheckTest(SimpleTestCase):
+    def test_number(self):
+        check = BASE_TYPE_CHECKS['NO']
+        self.assertEqual(check(3), 3)
+        self.assertEqual(check(2.5), 2.5)
+        self.assertEqual(check('2.5'), 2.5)
+        self.assertEqual(check('2.0'), 2)
+        self.assertEqual(check(' 7 '), 7)
+        for value in (True, 'abc', 'nan', 'inf', float('nan'), None):
+            with self.assertRaises(ValueError):
+                check(value)
+
+    def test_number_keeps_large_integer_strings_exact(self):
+        check = BASE_TYPE_CHECKS['NO']
+        self.assertEqual(check('12345678901234567890123'),
+                         12345678901234567890123)
+
+    def test_integer(self):
+        check = BASE_TYPE_CHECKS['IN']
+        self.assertEqual(check(3), 3)
+        self.assertEqual(check(3.0), 3)
+        self.assertEqual(check('-12'), -12)
+        self.assertEqual(check('123456789012345678901234567890'),
+                         123456789012345678901234567890)
+        for value in (False, 2.5, float('inf'), '2.5', 'abc', None):
+            with self.assertRaises(ValueError):
+                check(value)
+
+    def test_fraction(self):
+        check = BASE_TYPE_CHECKS['FR']
+        self.assertEqual(check('0.25'), 0.25)
+        self.assertEqual(check(1), 1.0)
+        for value in (True, 'abc', float('inf')):
+            with self.assertRaises(ValueError):
+                check(value)
+
+    def test_text(self):
+        check = BASE_TYPE_CHECKS['TX']
+        self.assertEqual(check('abc'), 'abc')
+        with self.assertRaises(ValueError):
+            check(12)
+
+
+class NormaliserTest(SimpleTestCase):
+    def test_telephone_numbers(self):
+        normalise = NORMALISERS['telephone-number']
+        self.assertEqual(normalise('+44 (20) 7946 0018'), '+442079460018')
+        self.assertEqual(normalise('020 7946 0018'), '02079460018')
+        with self.assertRaises(ValueError):
+            normalise('12345')
+        normalise = NORMALISERS['us-telephone-number']
+        self.assertEqual(normalise('(555) 123-4567'), '+15551234567')
+        self.assertEqual(normalise('1-555-123-4567'), '+15551234567')
+        with self.assertRaises(ValueError):
+            normalise('123-4567')
+
+    def test_post_codes(self):
+        self.assertEqual(NORMALISERS['gb-post-code']('sw1a2aa'), 'SW1A 2AA')
+        self.assertEqual(NORMALISERS['us-zip-code'](' 12345-6789 '),
+                         '12345-6789')
+        self.assertEqual(NORMALISERS['id-post-code']('40115'), '40115')
+        for full_type, value in (('gb-post-code', '12345'),
+                                 ('us-zip-code', '1234'),
+                                 ('id-post-code', 'AB123')):
+            with self.assertRaises(ValueError):
+                NORMALISERS[full_type](value)
+
+
+class AttributeValidatorTest(SimpleTestCase):
+    def setUp(self):
+        self.validator = AttributeValidator([
+            Attr('name', 'TX', '', 'R'),
+            Attr('age', 'IN', '', 'O'),
+            Attr('phone', 'TX', 'us-telephone-number', 'O'),
+        ])
+
+    def test_valid(self):
+        normalised, errors = self.validator.check(
+            {'name': 'Ana', 'age': '31', 'phone': '555.123.4567'}
+        )
+        self.assertEqual(normalised, {'name': 'Ana', 'age': 31,
+                                      'phone': '+15551234567'})
+        self.assertEqual(errors, {})
+
+    def test_errors(self):
+        normalised, errors = self.validator.check(
+            {'age': 'old', 'phone': None, 'height': 2}
+        )
+        self.assertEqual(normalised, {})
+        self.assertEqual(sorted(errors), ['age', 'height', 'name'])
+        self.assertEqual(errors['name'], 'value required')
+        self.assertEqual(errors['height'], 'unknown attribute')
+
+    def test_not_a_dict(self):
+        normalised, errors = self.validator.check(['Ana'])
+        self.assertIsNone(normalised)
+        self.assertIn('__all__', errors)
+
+    def test_validate(self):
+        self.assertEqual(self.validator.validate({'name': 'Ana'}),
+                         {'name': 'Ana'})
+        with self.assertRaises(ValidationError):
+            self.validator.validate({})